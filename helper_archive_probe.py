@@ -0,0 +1,330 @@
+#!/usr/bin/python3
+
+import json
+import sqlite3
+import struct
+import time
+from pathlib import Path
+
+import requests
+
+from helper_metadata_downloader import SUPPORTED_ARCHIVE_FORMATS
+from helper_metadata_downloader import SUPPORTED_GEOSPATIAL_FORMATS
+from helper_metadata_downloader import handle_http_error
+from helper_metadata_downloader import throttle
+from helper_sqlite_schema import migrate
+
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+EOCD_SIGNATURE = b"PK\x05\x06"
+ZIP64_EOCD_LOCATOR_SIGNATURE = b"PK\x06\x07"
+ZIP64_EOCD_SIGNATURE = b"PK\x06\x06"
+CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+
+EOCD = struct.Struct("<4s4H2IH")  # 22 bytes + comment (max. 65535 bytes)
+ZIP64_EOCD_LOCATOR = struct.Struct("<4sIQI")  # 20 bytes
+ZIP64_EOCD = struct.Struct("<4sQ2H2I4Q")  # 56 bytes
+# 46 bytes + name, extra, comment
+CENTRAL_DIRECTORY_ENTRY = struct.Struct("<4s6H3I5H2I")
+
+TAIL_SIZE = EOCD.size + 65535 + ZIP64_EOCD_LOCATOR.size + ZIP64_EOCD.size
+
+# retries of a range request after 429 or 5xx (with content_provider)
+MAX_RETRIES = 5
+
+
+class RangeNotSupported(Exception):
+    """Exception raised if a server ignores the Range header of a request."""
+
+    pass
+
+
+def fetch_range(
+    session: requests.Session,
+    url: str,
+    byte_range: str,
+    timeout: int = 30,
+    content_provider: str | None = None,
+) -> tuple[bytes, int | None]:
+    """
+    Returns the requested bytes and the total size of the remote file.
+
+    byte_range: e.g. "0-1023" or "-65536" (last 65536 bytes)
+    content_provider: paces every request with helper_metadata_downloader.throttle and
+                      retries after 429 and 5xx (waiting for retry-after)
+    """
+    retries_counter = 0
+    while True:
+        response = session.get(
+            url,
+            headers={"Range": f"bytes={byte_range}"},
+            stream=True,
+            timeout=timeout,
+        )
+        if content_provider is not None:
+            throttle(content_provider, response)
+
+        try:
+            response.raise_for_status()
+            break
+        except requests.HTTPError as e:
+            response.close()
+            if (
+                content_provider is None
+                or not is_transient_status(e.response.status_code)
+                or retries_counter >= MAX_RETRIES
+            ):
+                raise
+            handle_http_error(e)
+            retries_counter += 1
+
+    if response.status_code != 206:
+        # the server sends the whole file, do not read it
+        response.close()
+        raise RangeNotSupported(url)
+
+    # Content-Range: bytes 0-1023/146515
+    total_size = response.headers.get("content-range", "").rpartition("/")[2]
+    total_size = int(total_size) if total_size.isdigit() else None
+
+    return response.content, total_size
+
+
+def list_zip_members(
+    session: requests.Session, url: str, content_provider: str | None = None
+) -> list:
+    """
+    Returns the member names of a remote zip file by reading only its central directory.
+    """
+    tail, total_size = fetch_range(
+        session, url, f"-{TAIL_SIZE}", content_provider=content_provider
+    )
+    tail_offset = total_size - len(tail) if total_size else None
+
+    eocd_position = tail.rfind(EOCD_SIGNATURE)
+    if eocd_position < 0:
+        raise ValueError("No end of central directory record found.")
+
+    _, _, _, _, entries, cd_size, cd_offset, _ = EOCD.unpack_from(tail, eocd_position)
+
+    if entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+        locator_position = eocd_position - ZIP64_EOCD_LOCATOR.size
+        signature, _, zip64_eocd_offset, _ = ZIP64_EOCD_LOCATOR.unpack_from(
+            tail, locator_position
+        )
+        if signature != ZIP64_EOCD_LOCATOR_SIGNATURE or tail_offset is None:
+            raise ValueError("Invalid zip64 end of central directory locator.")
+        position = zip64_eocd_offset - tail_offset
+        record = tail[position : position + ZIP64_EOCD.size]
+        if position < 0 or len(record) < ZIP64_EOCD.size:
+            record, _ = fetch_range(
+                session,
+                url,
+                f"{zip64_eocd_offset}-{zip64_eocd_offset + ZIP64_EOCD.size - 1}",
+                content_provider=content_provider,
+            )
+        fields = ZIP64_EOCD.unpack_from(record)
+        if fields[0] != ZIP64_EOCD_SIGNATURE:
+            raise ValueError("Invalid zip64 end of central directory record.")
+        entries, cd_size, cd_offset = fields[7], fields[8], fields[9]
+
+    # use the central directory from the tail if possible, otherwise request it
+    if tail_offset is not None and cd_offset >= tail_offset:
+        central_directory = tail[
+            cd_offset - tail_offset : cd_offset - tail_offset + cd_size
+        ]
+    elif cd_size == 0:
+        central_directory = b""
+    else:
+        central_directory, _ = fetch_range(
+            session,
+            url,
+            f"{cd_offset}-{cd_offset + cd_size - 1}",
+            content_provider=content_provider,
+        )
+
+    members = []
+    position = 0
+    for _ in range(entries):
+        fields = CENTRAL_DIRECTORY_ENTRY.unpack_from(central_directory, position)
+        if fields[0] != CENTRAL_DIRECTORY_SIGNATURE:
+            raise ValueError("Invalid central directory entry.")
+        flags, name_length, extra_length, comment_length = (
+            fields[3],
+            fields[10],
+            fields[11],
+            fields[12],
+        )
+        position += CENTRAL_DIRECTORY_ENTRY.size
+        name = central_directory[position : position + name_length]
+        # bit 11: file name is UTF-8 encoded
+        members.append(name.decode("utf-8" if flags & 0x800 else "cp437", "replace"))
+        position += name_length + extra_length + comment_length
+
+    return members
+
+
+def probe_zip(
+    session: requests.Session, url: str, content_provider: str | None = None
+) -> dict:
+    """
+    Returns the probe result for a remote zip file, e.g.
+    {"status": "ok", "members": 12, "geospatial_members": ["a.shp"], "archive_members": []}
+    """
+    try:
+        members = list_zip_members(session, url, content_provider)
+    except RangeNotSupported:
+        return {"status": "range_not_supported"}
+    except requests.HTTPError as e:
+        return {"status": "http_error", "http_status_code": e.response.status_code}
+    except requests.RequestException as e:
+        print(f"DEBUG: Network error zip probe {url}:", e)
+        return {"status": "network_error"}
+    except Exception as e:
+        print(f"DEBUG: Exception zip probe {url}:", e)
+        return {"status": "error"}
+
+    files = [member for member in members if not member.endswith("/")]
+    geospatial_members = []
+    archive_members = []
+    for member in files:
+        extension = Path(member).suffix.lower()
+        if extension in SUPPORTED_GEOSPATIAL_FORMATS:
+            geospatial_members.append(member)
+        elif extension in SUPPORTED_ARCHIVE_FORMATS:
+            archive_members.append(member)
+
+    return {
+        "status": "ok",
+        "members": len(files),
+        "geospatial_members": geospatial_members,
+        "archive_members": archive_members,
+    }
+
+
+def is_transient_status(status_code: int) -> bool:
+    return status_code == 429 or 500 <= status_code <= 599
+
+
+def is_transient(probe: dict) -> bool:
+    """
+    True if the probe failed for a reason which may not happen again (rate limit, server
+    or network error), such probes are not persisted.
+    """
+    return probe["status"] == "network_error" or (
+        probe["status"] == "http_error"
+        and is_transient_status(probe["http_status_code"])
+    )
+
+
+def is_skippable(probe: dict | None) -> bool:
+    """
+    True if the probe proves that a zip file contains no (possibly) geospatial members.
+    """
+    return (
+        probe is not None
+        and probe["status"] == "ok"
+        and not probe["geospatial_members"]
+        and not probe["archive_members"]
+    )
+
+
+def get_download_flag(files: list, archive_probe: dict) -> bool:
+    """
+    Returns the download_flag of analyse_files, but without zip files which are proven
+    to contain no geospatial members.
+    """
+    for filename, _ in files:
+        extension = Path(filename).suffix.lower()
+        if extension == ".zip" and is_skippable(archive_probe.get(filename)):
+            continue
+        if extension in SUPPORTED_GEOSPATIAL_FORMATS + SUPPORTED_ARCHIVE_FORMATS:
+            return True
+
+    return False
+
+
+def probe_archives(
+    sqlite_path: str, content_provider: list | None = None, commit_interval: int = 100
+):
+    """
+    Probes the zip files of all datasets which are still to be analysed and persists the
+    results in datasets.archive_probe ({filename: probe}). The download_flag is removed
+    if no file of a dataset can contain geospatial data. Datasets with a transient
+    failure (is_transient) are probed again in the next run.
+    """
+    time_begin = time.time()
+
+    conn = sqlite3.connect(sqlite_path)
+    migrate(conn)
+    cursor = conn.cursor()
+
+    query = """
+        SELECT key, content_provider, files
+        FROM datasets
+        WHERE download_flag = 1 AND processed_flag = 0 AND (
+            archive_probe IS NULL
+            -- transient failures persisted by earlier versions
+            OR EXISTS (
+                SELECT 1 FROM json_each(archive_probe)
+                WHERE json_extract(value, '$.status') = 'http_error'
+                AND (
+                    json_extract(value, '$.http_status_code') = 429
+                    OR json_extract(value, '$.http_status_code') BETWEEN 500 AND 599
+                )
+            )
+        )
+    """
+    params = ()
+    if content_provider:
+        query += f" AND content_provider IN ({', '.join('?' * len(content_provider))})"
+        params = tuple(content_provider)
+    results = cursor.execute(query, params).fetchall()
+
+    session = requests.Session()
+    counter_probed = 0
+    counter_skipped = 0
+    counter_retry = 0
+
+    for index, (key, provider, files) in enumerate(results):
+        files = json.loads(files)
+        archive_probe = {}
+
+        for filename, file_link in files:
+            if Path(filename).suffix.lower() == ".zip":
+                archive_probe[filename] = probe_zip(session, file_link, provider)
+                counter_probed += 1
+
+        if any(is_transient(probe) for probe in archive_probe.values()):
+            # not persisted, the dataset is probed again in the next run
+            counter_retry += 1
+        else:
+            download_flag = get_download_flag(files, archive_probe)
+            if not download_flag:
+                counter_skipped += 1
+
+            cursor.execute(
+                "UPDATE datasets SET archive_probe = ?, download_flag = ? WHERE key = ?",
+                (json.dumps(archive_probe), 1 if download_flag else 0, key),
+            )
+
+        if (index + 1) % commit_interval == 0:
+            conn.commit()
+
+        print(
+            f"\r\033[KProbed {counter_probed} zip files of {index + 1}/{len(results)} datasets, "
+            + f"{counter_skipped} datasets without geospatial files, "
+            + f"{counter_retry} datasets to probe again.",
+            end="",
+        )
+
+    conn.commit()
+    conn.close()
+
+    time_str = time.strftime("%H:%M:%S", time.gmtime(time.time() - time_begin))
+    print(f"\nFinished archive probing in {time_str}")
+
+
+if __name__ == "__main__":
+    sqlite_path = "/home/lars/FINAL_metadata_db.sqlite3"
+
+    probe_archives(sqlite_path)
@@ -1,10 +1,13 @@
 #!/usr/bin/python3
 
 import csv
-import json
 import sqlite3
 from pathlib import Path
 
+from helper_metadata_compression import register_metadata_functions
+from helper_sqlite_schema import BBOX_COLUMNS_VERSION
+from helper_sqlite_schema import check_schema_version
+
 
 def save_csv(sqlite_path: str, csv_path: str, query: str):
     if csv_path.exists():
@@ -12,6 +15,8 @@ def save_csv(sqlite_path: str, csv_path: str, query: str):
         return
 
     conn = sqlite3.connect(sqlite_path)
+    check_schema_version(conn, BBOX_COLUMNS_VERSION)
+    register_metadata_functions(conn)
     cursor = conn.cursor()
 
     cursor.execute(query)
@@ -45,10 +50,8 @@ def save_csv(sqlite_path: str, csv_path: str, query: str):
     )
 
     for dataset in results:
-        bbox = dataset[20]
-
-        if bbox:
-            minx, miny, maxx, maxy = json.loads(bbox)
+        if dataset[20] is not None:
+            minx, miny, maxx, maxy = dataset[20:24]
             wkt = f"POLYGON(({minx} {miny}, {maxx} {miny}, {maxx} {maxy}, {minx} {maxy}, {minx} {miny}))"
 
             # verify with https://wktmap.com
@@ -109,12 +112,15 @@ def create_csv(sqlite_path: str):
         processed_flag,
         timeout,
         time_result_insert,
-        bbox
+        bbox_minx,
+        bbox_miny,
+        bbox_maxx,
+        bbox_maxy
     """
 
     EXPORT_JOBS = [
         ("", ""),
-        ("_processed", "WHERE processed_flag is 1"),
+        ("_processed", "WHERE processed_flag = 1"),
         ("_processed_with_bbox", "WHERE bbox is not NULL"),
     ]
 
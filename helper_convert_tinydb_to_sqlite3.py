@@ -2,122 +2,270 @@
 
 import sqlite3
 import json
+import re
+import time
 from pathlib import Path
-from tinydb import TinyDB
+
+from helper_metadata_compression import MetadataCodec
+from helper_metadata_compression import save_dictionary
+from helper_metadata_compression import train_dictionary
+from helper_metadata_downloader import get_files
+from helper_quantile_sketch import seed_sketches
+from helper_quantile_sketch import update_sketches
+from helper_sqlite_schema import INSERT_DATASET_FILE_QUERY
+from helper_sqlite_schema import create_dataset_files_table
+from helper_sqlite_schema import get_dataset_file_rows
+from helper_sqlite_schema import migrate
+
+# columns of the datasets table which are derived from get_normalized_metadata
+NORMALIZED_COLUMNS = [
+    "content_provider",
+    "created_date",
+    "modified_date",
+    "id",
+    "doi",
+    "url_api",
+    "url_html",
+    "title",
+    "description",
+    "keywords",
+    "sum_size",
+    "files_types",
+    "files",
+    "geospatial_flag",
+    "download_flag",
+]
+
+
+def get_normalized_row(normalized_metadata: dict) -> tuple:
+    """
+    Returns the values of NORMALIZED_COLUMNS as stored in the datasets table.
+    """
+    return (
+        normalized_metadata["content_provider"],
+        normalized_metadata["created_date"],
+        normalized_metadata["modified_date"],
+        str(normalized_metadata["id"]),
+        normalized_metadata["doi"],
+        normalized_metadata["url_api"],
+        normalized_metadata["url_html"],
+        normalized_metadata["title"],
+        normalized_metadata["description"],
+        json.dumps(normalized_metadata["keywords"]),
+        normalized_metadata["sum_size"],
+        json.dumps(normalized_metadata["files_types"]),
+        json.dumps(normalized_metadata["files"]),
+        1 if normalized_metadata["geospatial_flag"] else 0,
+        1 if normalized_metadata["download_flag"] else 0,
+    )
 
 
 def convert_tinydb_to_sqlite3(
     tinydb_paths: list,
     sqlite_path: str,
+    compression: str | None = None,
+    dictionary_samples: int = 1000,
+    chunk_size: int = 10000,
+    cache_size_mib: int = 512,
+    sketch_paths: list | None = None,
 ):
+    """
+    Converts the harvested TinyDB files into the SQLite3 datasets table.
+
+    compression: None stores the raw metadata as JSON text, "zlib" or "zstd" stores it as
+                 compressed blob with a shared dictionary per content provider
+                 (decode with helper_metadata_compression.MetadataCodec).
+    chunk_size: rows per executemany
+    cache_size_mib: SQLite page cache during the bulk load
+    sketch_paths: quantile sketch files of the metadata harvester (<checkpoint>_sketches.json)
+                  for the converted TinyDB files, persisted as the initial sketches
+    """
     if Path(sqlite_path).is_file():
         print(f"Output file {sqlite_path} already exist.")
         return
 
-    all_datasets = []
-    print("Reading tinydb...")
-    for tinydb_path in tinydb_paths:
-        db = TinyDB(tinydb_path)
-        all_datasets.extend(db.all())
+    time_begin = time.time()
 
-    conn = sqlite3.connect(sqlite_path)
+    # write to a temporary file, a crash during the bulk load leaves no broken output
+    part_path = Path(sqlite_path).with_name(Path(sqlite_path).name + ".part")
+    part_path.unlink(missing_ok=True)
+
+    conn = sqlite3.connect(part_path)
     cursor = conn.cursor()
 
-    # Create tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS statistics_dataset_analysis (
-            id INTEGER PRIMARY KEY,
-            content_provider TEXT,
-            processed_counter INTEGER,
-            processed_data_volume INTEGER,
-            timeout_counter INTEGER,
-            with_bbox INTEGER
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS datasets (
-            key INTEGER PRIMARY KEY,
-            content_provider TEXT,
-            created_date TEXT,
-            modified_date TEXT,
-            id TEXT,
-            doi TEXT,
-            url_api TEXT,
-            url_html TEXT,
-            title TEXT,
-            description TEXT,
-            keywords TEXT,
-            sum_size INTEGER,
-            files_types TEXT,
-            files TEXT,
-            files_http_status_code TEXT,
-            geospatial_flag INTEGER,
-            download_flag INTEGER,
-            processed_flag INTEGER,
-            timeout INTEGER,
-            bbox TEXT,
-            time_result_insert INTEGER,
-            metadata TEXT
-        )
-    """)
+    # Bulk-load settings, reset after the load
+    cursor.execute("PRAGMA journal_mode = OFF")
+    cursor.execute("PRAGMA synchronous = OFF")
+    cursor.execute(f"PRAGMA cache_size = -{cache_size_mib * 1024}")
+
+    # Create tables, the remaining migrations (e.g. indexes) follow after the load
+    migrate(conn, target_version=1)
+    create_dataset_files_table(cursor)
+
+    # Train one shared dictionary per content provider on the first records
+    if compression:
+        samples = {}
+        for index, dataset in enumerate(iter_tinydb_documents(tinydb_paths[0])):
+            if index >= 3 * dictionary_samples:
+                break
+            content_provider = dataset.pop("normalized_metadata")["content_provider"]
+            provider_samples = samples.setdefault(content_provider, [])
+            if len(provider_samples) < dictionary_samples:
+                provider_samples.append(dataset)
+
+        for content_provider, provider_samples in samples.items():
+            dictionary = train_dictionary(provider_samples, compression)
+            save_dictionary(conn, content_provider, compression, dictionary)
+            print(
+                f"Trained {compression} dictionary for {content_provider} "
+                + f"({len(dictionary)} B)."
+            )
+
+    codec = MetadataCodec.from_db(conn)
 
     # Use parameterized query for inserting data
     insert_query = """
         INSERT INTO datasets (
-            content_provider, created_date, modified_date, id, doi, url_api, 
-            url_html, title, description, keywords, sum_size, 
-            files_types, files, files_http_status_code, geospatial_flag, download_flag, processed_flag, timeout, bbox, time_result_insert, metadata
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            key, content_provider, created_date, modified_date, id, doi, url_api,
+            url_html, title, description, keywords, sum_size,
+            files_types, files, geospatial_flag, download_flag, files_http_status_code, processed_flag, timeout, bbox, time_result_insert, metadata
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """
 
     counter = 0
+    rows = []
+    file_rows = []
 
     # Insert data from TinyDB into SQLite
-    for dataset in all_datasets:
-        files_http_status_code = None
-        timeout = None
-        bbox = None
-        time_result_insert = None
-
-        metadata = dataset
-        normalized_metadata = metadata.pop("normalized_metadata")
-
-        cursor.execute(
-            insert_query,
-            (
-                normalized_metadata["content_provider"],
-                normalized_metadata["created_date"],
-                normalized_metadata["modified_date"],
-                str(normalized_metadata["id"]),
-                normalized_metadata["doi"],
-                normalized_metadata["url_api"],
-                normalized_metadata["url_html"],
-                normalized_metadata["title"],
-                normalized_metadata["description"],
-                json.dumps(normalized_metadata["keywords"]),
-                normalized_metadata["sum_size"],
-                json.dumps(normalized_metadata["files_types"]),
-                json.dumps(normalized_metadata["files"]),
-                files_http_status_code,
-                1 if normalized_metadata["geospatial_flag"] else 0,
-                1 if normalized_metadata["download_flag"] else 0,
-                0,
-                timeout,
-                bbox,
-                time_result_insert,
-                json.dumps(metadata),
-            ),
-        )
-
-        counter += 1
-        print(counter, end="\r")
-
-    print("Finished writing sqlite.")
-
-    # Save changes and close connection
+    for tinydb_path in tinydb_paths:
+        print(f"\r\033[KReading {tinydb_path}...")
+
+        for dataset in iter_tinydb_documents(tinydb_path):
+            files_http_status_code = None
+            timeout = None
+            bbox = None
+            time_result_insert = None
+
+            metadata = dataset
+            normalized_metadata = metadata.pop("normalized_metadata")
+            content_provider = normalized_metadata["content_provider"]
+            key = counter + len(rows) + 1
+
+            file_rows.extend(
+                get_dataset_file_rows(key, get_files(content_provider, metadata))
+            )
+            rows.append(
+                (
+                    key,
+                    *get_normalized_row(normalized_metadata),
+                    files_http_status_code,
+                    0,
+                    timeout,
+                    bbox,
+                    time_result_insert,
+                    codec.encode(content_provider, metadata),
+                )
+            )
+
+            if len(rows) >= chunk_size:
+                cursor.executemany(insert_query, rows)
+                cursor.executemany(INSERT_DATASET_FILE_QUERY, file_rows)
+                counter += len(rows)
+                rows = []
+                file_rows = []
+                print_progress(counter, time_begin)
+
+    cursor.executemany(insert_query, rows)
+    cursor.executemany(INSERT_DATASET_FILE_QUERY, file_rows)
+    counter += len(rows)
+    print_progress(counter, time_begin)
+
+    # Save changes, reset the bulk-load settings and close connection
     conn.commit()
+    cursor.execute("PRAGMA journal_mode = DELETE")
+    cursor.execute("PRAGMA synchronous = FULL")
+    migrate(conn)
     conn.close()
 
+    part_path.rename(sqlite_path)
+
+    print("\nFinished writing sqlite.")
+
+    # sketches of the sizes, from the harvester or from the datasets (update_sketches
+    # adds later rows)
+    if sketch_paths:
+        seed_sketches(sqlite_path, sketch_paths)
+    update_sketches(sqlite_path)
+
+
+def print_progress(counter: int, time_begin: float):
+    rows_per_second = counter / max(time.time() - time_begin, 1e-6)
+    print(f"\r\033[K{counter} rows ({rows_per_second:.0f} rows/s)", end="")
+
+
+def iter_tinydb_documents(
+    tinydb_path: str, table: str = "_default", read_size: int = 16 * 1024 * 1024
+):
+    """
+    Yields the documents of a TinyDB JSON file without loading the whole file.
+
+    TinyDB stores {"table": {"doc_id": {document}, ...}, ...} in a single line, the file
+    is read in blocks and parsed document by document.
+    """
+    decoder = json.JSONDecoder()
+    separators = re.compile(r"[\s,:]*")
+
+    with open(tinydb_path, encoding="utf-8") as file:
+        buffer = ""
+        position = 0
+
+        def read_more() -> bool:
+            nonlocal buffer, position
+            data = file.read(read_size)
+            buffer = buffer[position:] + data
+            position = 0
+            return bool(data)
+
+        def next_char() -> str:
+            nonlocal position
+            while True:
+                position = separators.match(buffer, position).end()
+                if position < len(buffer):
+                    return buffer[position]
+                if not read_more():
+                    raise ValueError(f"Unexpected end of file {tinydb_path}")
+
+        def next_value():
+            nonlocal position
+            next_char()
+            while True:
+                try:
+                    value, position = decoder.raw_decode(buffer, position)
+                    return value
+                except json.JSONDecodeError:
+                    # value is incomplete, read the next block
+                    if not read_more():
+                        raise
+
+        def expect(char: str):
+            nonlocal position
+            if next_char() != char:
+                raise ValueError(f"Invalid TinyDB file {tinydb_path}")
+            position += 1
+
+        expect("{")
+        while next_char() != "}":
+            table_name = next_value()
+            if table_name != table:
+                next_value()
+                continue
+
+            expect("{")
+            while next_char() != "}":
+                next_value()  # document id
+                yield next_value()
+            expect("}")
+
 
 if __name__ == "__main__":
     tinydb_paths = [
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def normalize_checksum(checksum: str | None) -> str | None:
+    # e.g. "MD5:ABC..." -> "md5:abc...", dryad "SHA-256:..." -> "sha256:..."
+    if not checksum or ":" not in checksum:
+        return None
+    algorithm, _, digest = checksum.partition(":")
+    algorithm = algorithm.lower().replace("-", "")
+    if algorithm not in hashlib.algorithms_available or not digest.isalnum():
+        return None
+    return f"{algorithm}:{digest.lower()}"
+
+
+class DownloadCache:
+    """
+    Content-addressed cache of downloaded files, keyed by the checksum of the provider
+    (or the sha256 of the file) with the download URL as alias. Files are hardlinked
+    into the staging directories, the least recently used files are evicted above
+    max_bytes.
+
+    The cache must be on the same file system as the staging directories, otherwise
+    files are copied.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.joinpath("objects").mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            self.path.joinpath("index.sqlite3"), check_same_thread=False
+        )
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS objects (
+                checksum TEXT PRIMARY KEY,
+                size INTEGER,
+                last_access REAL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS aliases (
+                url TEXT PRIMARY KEY,
+                checksum TEXT
+            )
+        """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS objects_last_access ON objects (last_access)"
+        )
+        self.conn.commit()
+
+    def _object_path(self, checksum: str) -> Path:
+        algorithm, _, digest = checksum.partition(":")
+        return self.path.joinpath("objects", algorithm, digest[:2], digest)
+
+    def size(self) -> int:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM objects"
+            ).fetchone()[0]
+
+    def lookup(self, checksum: str | None, url: str) -> Path | None:
+        checksum = normalize_checksum(checksum)
+        with self._lock:
+            if checksum is None:
+                row = self.conn.execute(
+                    "SELECT checksum FROM aliases WHERE url = ?", (url,)
+                ).fetchone()
+                if row is None:
+                    return None
+                checksum = row[0]
+
+            if not self._object_path(checksum).is_file():
+                self.conn.execute("DELETE FROM objects WHERE checksum = ?", (checksum,))
+                self.conn.commit()
+                return None
+
+            self.conn.execute(
+                "UPDATE objects SET last_access = ? WHERE checksum = ?",
+                (time.time(), checksum),
+            )
+            self.conn.commit()
+            return self._object_path(checksum)
+
+    def link(self, cached_path: Path, filepath: Path) -> bool:
+        """
+        Links (or copies) a cached file to filepath. Returns False if the file was evicted
+        since lookup (cache miss).
+        """
+        filepath.unlink(missing_ok=True)
+        try:
+            os.link(cached_path, filepath)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # other file system, the file gets its final name after the copy
+            temp_path = filepath.with_name(filepath.name + ".tmp")
+            try:
+                shutil.copyfile(cached_path, temp_path)
+            except FileNotFoundError:
+                temp_path.unlink(missing_ok=True)
+                return False
+            temp_path.rename(filepath)
+        return True
+
+    def add(self, filepath: Path, checksum: str | None, url: str):
+        """
+        Adds a downloaded and validated file (invalid files must not be added, they would
+        be served for their URL). Without a checksum of the provider, the sha256 of the
+        file is used.
+        """
+        checksum = normalize_checksum(checksum)
+        if checksum is None:
+            hash_object = hashlib.sha256()
+            with open(filepath, "rb") as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    hash_object.update(chunk)
+            checksum = f"sha256:{hash_object.hexdigest()}"
+
+        size = filepath.stat().st_size
+        if size > self.max_bytes:
+            return
+
+        object_path = self._object_path(checksum)
+        with self._lock:
+            if not object_path.is_file():
+                object_path.parent.mkdir(parents=True, exist_ok=True)
+                temp_path = object_path.with_name(object_path.name + ".tmp")
+                temp_path.unlink(missing_ok=True)
+                try:
+                    os.link(filepath, temp_path)
+                except OSError:
+                    shutil.copyfile(filepath, temp_path)
+                temp_path.rename(object_path)
+
+            self.conn.execute(
+                "INSERT OR REPLACE INTO objects (checksum, size, last_access) VALUES (?, ?, ?)",
+                (checksum, size, time.time()),
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO aliases (url, checksum) VALUES (?, ?)",
+                (url, checksum),
+            )
+            self._evict(keep=checksum)
+            self.conn.commit()
+
+    def _evict(self, keep: str):
+        total = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM objects"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for checksum, size in self.conn.execute(
+            "SELECT checksum, size FROM objects WHERE checksum != ? ORDER BY last_access",
+            (keep,),
+        ).fetchall():
+            # hardlinks in staging directories keep their data
+            self._object_path(checksum).unlink(missing_ok=True)
+            self.conn.execute("DELETE FROM objects WHERE checksum = ?", (checksum,))
+            self.conn.execute("DELETE FROM aliases WHERE checksum = ?", (checksum,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from geoextent.__init__ import __version__ as geoextent_version
+
+from helper_timeout_model import get_timing_row
+
+CHUNK_SIZE = 1024 * 1024
+
+INSERT_FILE_EXTENT_QUERY = """
+    INSERT OR REPLACE INTO file_extents
+    (file_hash, size, geoextent_version, options, bbox, format, processing_time, time_insert)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def hash_path(path: str) -> tuple[str, int]:
+    """
+    Returns the sha256 and size of a file, or of all files in a directory (relative
+    paths included).
+    """
+    path = Path(path)
+    if path.is_file():
+        hash_object = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                hash_object.update(chunk)
+        return hash_object.hexdigest(), path.stat().st_size
+
+    hash_object = hashlib.sha256()
+    size = 0
+    for file in sorted(file for file in path.rglob("*") if file.is_file()):
+        file_hash, file_size = hash_path(file)
+        hash_object.update(f"{file.relative_to(path)}\0{file_hash}\0".encode())
+        size += file_size
+    return hash_object.hexdigest(), size
+
+
+def get_options(mode: str) -> str:
+    # without the timeout: only results which finished within it are stored, and the
+    # timeout changes between runs (helper_timeout_model)
+    options = {"mode": mode, "bbox": True}
+    return json.dumps(options, sort_keys=True)
+
+
+class ExtentMemo:
+    """
+    Runs geoextent on the GeoextentPool unless the result for the same input (hash and
+    size of the file or directory), geoextent version and options is in file_extents.
+    Only clean results are stored, not timeouts or errors (exception in geoextent, died
+    process). New results are collected in rows, the processing times of geoextent in timings
+    (helper_timeout_model), both are written by result_consumer.
+    """
+
+    def __init__(self, pool, conn: sqlite3.Connection):
+        self.pool = pool
+        self.conn = conn
+        self.rows = []
+        self.timings = []
+        self._lock = threading.Lock()
+
+    def lookup(self, file_hash: str, size: int, options: str) -> dict | None:
+        with self._lock:
+            row = self.conn.execute(
+                """
+                SELECT bbox, format FROM file_extents
+                WHERE file_hash = ? AND size = ? AND geoextent_version = ? AND options = ?
+                """,
+                (file_hash, size, geoextent_version, options),
+            ).fetchone()
+        if row is None:
+            return None
+
+        bbox, file_format = row
+        if bbox is None:
+            return {}
+        return {"bbox": json.loads(bbox), "crs": "4326", "format": file_format}
+
+    def run(
+        self,
+        path: str,
+        timeout_geoextent: int,
+        timeout_process: int,
+        key: int,
+        mode: str = "directory",
+    ) -> dict:
+        file_hash, size = hash_path(path)
+        options = get_options(mode)
+
+        metadata = self.lookup(file_hash, size, options)
+        if metadata is not None:
+            return metadata
+
+        metadata, processing_time = self.pool.run_timed(
+            path, timeout_geoextent, timeout_process, key, mode=mode
+        )
+        if "error" not in metadata:
+            # crashes are no processing times (helper_timeout_model)
+            self.timings.append(
+                get_timing_row(
+                    path,
+                    mode,
+                    processing_time,
+                    timeout_geoextent,
+                    "timeout" in metadata,
+                )
+            )
+
+        if "timeout" not in metadata and "error" not in metadata:
+            # clean result, which is final for this input (a crash, out of memory or a
+            # timeout may not happen again)
+            bbox = metadata.get("bbox")
+            if not bbox or any(math.isnan(x) for x in bbox):
+                bbox = None
+            self.rows.append(
+                (
+                    file_hash,
+                    size,
+                    geoextent_version,
+                    options,
+                    json.dumps(bbox) if bbox else None,
+                    metadata.get("format"),
+                    processing_time,
+                    int(time.time()),
+                )
+            )
+
+        return metadata
@@ -0,0 +1,566 @@
+#!/usr/bin/python3
+
+import math
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import struct
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from pathlib import Path
+
+import geoextent.lib.extent as geoextent
+
+from helper_metadata_downloader import SUPPORTED_ARCHIVE_FORMATS
+from helper_metadata_downloader import SUPPORTED_GEOSPATIAL_FORMATS
+
+# archives which can be extracted with shutil.unpack_archive, other archives are passed
+# to geoextent.fromDirectory (patool)
+UNPACK_FORMATS = [
+    extension
+    for _, extensions, _ in shutil.get_unpack_formats()
+    for extension in extensions
+]
+
+# estimated ratio of uncompressed to compressed size if the archive does not state it
+# (bzip2, xz)
+UNPACK_SIZE_RATIO = 5
+
+
+def _unpack(path: str) -> dict:
+    # runs in the pool process: killable and with the memory limit of the process
+    archive = Path(path)
+    target = archive.with_name(archive.name + ".extracted")
+    if _unpack_suffix(archive) == ".zip":
+        # members with absolute paths or ".." are skipped by shutil
+        shutil.unpack_archive(archive, target)
+    else:
+        shutil.unpack_archive(archive, target, filter="data")
+    return {"unpacked": str(target)}
+
+
+def _pool_worker(connection: Connection, max_memory_bytes: int | None = None):
+    if max_memory_bytes:
+        # MemoryError (or a crash of GDAL) in this process instead of the OOM killer
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+
+    # geoextent (GDAL, pandas, ...) is imported once per process, not once per dataset
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        mode, path, timeout, key = task
+        try:
+            if mode == "unpack":
+                metadata = _unpack(path)
+            elif mode == "file":
+                metadata = geoextent.fromFile(path, bbox=True)
+            else:
+                metadata = geoextent.fromDirectory(
+                    path=path, bbox=True, timeout=timeout
+                )
+        except Exception as e:
+            print(f"DEBUG: {key} Exception geoextent:", e)
+            # not a result for this input, e.g. MemoryError (RLIMIT_AS)
+            metadata = {"error": f"{type(e).__name__}: {e}"}
+        connection.send(metadata)
+
+
+class _WorkerProcess:
+    def __init__(self, max_memory_bytes: int | None = None):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_pool_worker,
+            args=(child_connection, max_memory_bytes),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+
+    def rss(self) -> int:
+        # resident set size [B] from /proc (Linux), 0 if unknown
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.kill()
+        self.connection.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+
+class GeoextentPool:
+    """
+    Long-lived worker processes for geoextent.fromDirectory. A process is killed and
+    replaced if a task exceeds its timeout (the timeout of geoextent does not work,
+    e.g. while a huge csv file is being processed) or if its memory grows above
+    max_rss_bytes. max_memory_bytes is the address space limit (RLIMIT_AS) of each
+    process. The number of processes can be changed with resize (PoolAutoscaler).
+
+    Example:
+        pool = GeoextentPool(6)
+        metadata = pool.run(tmp_dir.name, 30 * 60, 60 * 60, key)
+        pool.close()
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        max_rss_bytes: int | None = 4 * 1024**3,
+        max_memory_bytes: int | None = None,
+    ):
+        self.processes = processes
+        self.max_rss_bytes = max_rss_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._condition = threading.Condition()
+        self._idle = []
+        self._busy = set()
+        self._waiting = 0
+        self._spawned = 0
+        self._closed = False
+
+    def _acquire(self) -> _WorkerProcess:
+        with self._condition:
+            self._waiting += 1
+            while not self._idle and self._spawned >= self.processes:
+                self._condition.wait()
+            self._waiting -= 1
+            worker = self._idle.pop() if self._idle else None
+            if worker is not None and worker.process.is_alive():
+                self._busy.add(worker)
+                return worker
+            if worker is None:
+                self._spawned += 1
+
+        if worker is not None:
+            # the idle process died between tasks (e.g. killed by the OOM killer),
+            # it is replaced by a new process
+            worker.kill()
+
+        try:
+            worker = _WorkerProcess(self.max_memory_bytes)
+        except Exception:
+            with self._condition:
+                self._spawned -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._busy.add(worker)
+        return worker
+
+    def _release(self, worker: _WorkerProcess | None, acquired: _WorkerProcess):
+        stop = False
+        with self._condition:
+            self._busy.discard(acquired)
+            if worker is None:
+                self._spawned -= 1
+            elif self._closed or self._spawned > self.processes:
+                # pool was resized or closed
+                self._spawned -= 1
+                stop = True
+            else:
+                self._idle.append(worker)
+            self._condition.notify()
+
+        # outside of the lock, stop() waits up to 10 s for the process
+        if stop:
+            worker.stop()
+
+    def run(
+        self,
+        path: str,
+        timeout_geoextent: int,
+        timeout_process: int,
+        key: int,
+        mode: str = "directory",
+    ):
+        """
+        Returns the metadata of geoextent.fromDirectory (mode "directory") or
+        geoextent.fromFile (mode "file") for path, {"timeout": timeout_process} if the
+        process had to be killed, or {"error": ...} if geoextent raised an exception or
+        the process died.
+        """
+        return self.run_timed(path, timeout_geoextent, timeout_process, key, mode)[0]
+
+    def run_timed(
+        self,
+        path: str,
+        timeout_geoextent: int,
+        timeout_process: int,
+        key: int,
+        mode: str = "directory",
+    ) -> tuple[dict, float]:
+        """
+        Like run, but also returns the processing time [s] of the task in the process,
+        without the wait for a free process and the start of a new one.
+        """
+        worker = acquired = self._acquire()
+        time_begin = time.time()
+        try:
+            worker.connection.send((mode, path, timeout_geoextent, key))
+            if worker.connection.poll(timeout_process):
+                metadata = worker.connection.recv()
+                processing_time = time.time() - time_begin
+            else:
+                print(f"Process terminated after {timeout_process} s. Key:", key)
+                worker.kill()
+                worker = None
+                metadata = {"timeout": timeout_process}
+                processing_time = time.time() - time_begin
+
+            if (
+                worker is not None
+                and self.max_rss_bytes
+                and worker.rss() > self.max_rss_bytes
+            ):
+                print(
+                    f"INFO: Restart geoextent process with {worker.rss() / 1024**3:.1f} GiB RSS."
+                )
+                worker.stop()
+                worker = None
+
+        except (EOFError, OSError) as e:
+            # the process died, e.g. segmentation fault in GDAL or out of memory
+            print(f"DEBUG: {key} Exception geoextent process:", e)
+            if worker is not None:
+                worker.kill()
+            worker = None
+            metadata = {"error": f"process died: {e!r}"}
+            processing_time = time.time() - time_begin
+
+        except BaseException:
+            # e.g. pickling error, the state of the process is unknown
+            if worker is not None:
+                worker.kill()
+            worker = None
+            raise
+
+        finally:
+            self._release(worker, acquired)
+
+        return metadata, processing_time
+
+    def demand(self) -> int:
+        # running tasks and tasks waiting for a process
+        with self._condition:
+            return len(self._busy) + self._waiting
+
+    def rss(self) -> list:
+        # resident set sizes [B] of the running processes
+        with self._condition:
+            workers = [*self._idle, *self._busy]
+        return [worker.rss() for worker in workers]
+
+    def resize(self, processes: int):
+        stopped = []
+        with self._condition:
+            self.processes = max(1, processes)
+            while self._idle and self._spawned > self.processes:
+                stopped.append(self._idle.pop())
+                self._spawned -= 1
+            self._condition.notify_all()
+
+        # outside of the lock, stop() waits up to 10 s for the process
+        for worker in stopped:
+            worker.stop()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            stopped = self._idle
+            self._spawned -= len(self._idle)
+            self._idle = []
+
+        for worker in stopped:
+            worker.stop()
+
+
+def get_mem_available() -> int:
+    # available memory [B] from /proc (Linux) incl. page cache, 0 if unknown
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def get_cpu_count() -> int:
+    # cores which this process may use (e.g. taskset, cgroups)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class PoolAutoscaler:
+    """
+    Resizes the GeoextentPool every interval seconds to the smallest of
+    - the cores (max_processes),
+    - the processes for which memory is available: MemAvailable plus the RSS of the
+      running processes minus reserve_bytes, divided by the peak RSS of a process (at
+      least min_rss_bytes), as every process can grow to the peak,
+    - the demand: running and waiting tasks of the pool plus the datasets in
+      geoextent_queue,
+    but at least min_processes.
+
+    Example:
+        autoscaler = PoolAutoscaler(pool, geoextent_queue)
+        autoscaler.start()
+        ...
+        autoscaler.stop()
+    """
+
+    def __init__(
+        self,
+        pool: GeoextentPool,
+        geoextent_queue: queue.Queue,
+        min_processes: int = 1,
+        max_processes: int | None = None,
+        reserve_bytes: int = 2 * 1024**3,
+        min_rss_bytes: int = 512 * 1024**2,
+        interval: float = 10,
+    ):
+        self.pool = pool
+        self.geoextent_queue = geoextent_queue
+        self.min_processes = min_processes
+        self.max_processes = max_processes or get_cpu_count()
+        self.reserve_bytes = reserve_bytes
+        self.min_rss_bytes = min_rss_bytes
+        self.interval = interval
+        self.peak_rss = min_rss_bytes
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def get_target(self) -> int:
+        rss = self.pool.rss()
+        # the peak decays slowly, e.g. after a huge raster
+        self.peak_rss = max(self.min_rss_bytes, 0.95 * self.peak_rss, *rss)
+
+        mem_available = get_mem_available()
+        if mem_available:
+            memory_processes = math.floor(
+                (mem_available + sum(rss) - self.reserve_bytes) / self.peak_rss
+            )
+        else:
+            memory_processes = self.max_processes
+        demand = self.pool.demand() + self.geoextent_queue.qsize()
+
+        return max(
+            self.min_processes,
+            min(self.max_processes, memory_processes, demand),
+        )
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            target = self.get_target()
+            if target != self.pool.processes:
+                print(
+                    f"INFO: Resize geoextent pool {self.pool.processes} -> {target} "
+                    + f"(MemAvailable {get_mem_available() / 1024**3:.1f} GiB, "
+                    + f"peak RSS {self.peak_rss / 1024**3:.1f} GiB)."
+                )
+                self.pool.resize(target)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+
+def _unpack_suffix(path: Path) -> str | None:
+    name = path.name.lower()
+    for extension in sorted(UNPACK_FORMATS, key=len, reverse=True):
+        if name.endswith(extension):
+            return extension
+    return None
+
+
+def get_unpacked_size(archive: Path) -> int | None:
+    """
+    Returns the (estimated) size of the extracted archive, or None if it cannot be read.
+    """
+    size = archive.stat().st_size
+    suffix = _unpack_suffix(archive)
+    try:
+        if suffix == ".zip":
+            with zipfile.ZipFile(archive) as zip_file:
+                return sum(info.file_size for info in zip_file.infolist())
+        if suffix in (".tar.gz", ".tgz"):
+            # ISIZE of the (last) gzip member: uncompressed size modulo 2**32
+            with open(archive, "rb") as f:
+                f.seek(-4, 2)
+                return max(size, struct.unpack("<I", f.read(4))[0])
+    except (OSError, zipfile.BadZipFile, struct.error):
+        return None
+    if suffix == ".tar":
+        return size
+    return size * UNPACK_SIZE_RATIO
+
+
+def get_geoextent_tasks(
+    pool: GeoextentPool,
+    path: str,
+    timeout_process: int,
+    key: int,
+    tmp_dir=None,
+    max_depth: int = 3,
+) -> list:
+    """
+    Extracts the archives in path (nested up to max_depth) in the pool and returns the
+    tasks [(mode, path), ...] for GeoextentPool.run: one "file" task per geospatial file
+    and one "directory" task per archive which cannot be extracted here (unknown format,
+    error, timeout or not enough space), which geoextent extracts itself.
+
+    tmp_dir: helper_staging.BudgetedDirectory of path, the extracted size is reserved in
+             its budget before an archive is extracted
+    """
+    failed = set()
+    for depth in range(max_depth):
+        archives = [
+            file
+            for file in Path(path).rglob("*")
+            if file.is_file() and _unpack_suffix(file) and file not in failed
+        ]
+        if not archives:
+            break
+        for archive in archives:
+            unpacked_size = get_unpacked_size(archive)
+            if unpacked_size is None or (
+                tmp_dir is not None and not tmp_dir.grow(unpacked_size)
+            ):
+                print(
+                    f"INFO: {key} {archive.name} is not extracted (unreadable or no space)."
+                )
+                failed.add(archive)
+                continue
+
+            metadata = pool.run(str(archive), None, timeout_process, key, mode="unpack")
+            if "unpacked" in metadata:
+                # the extracted members replace the archive
+                archive.unlink()
+            else:
+                print(f"DEBUG: {key} Exception unpack {archive.name}:", metadata)
+                shutil.rmtree(
+                    archive.with_name(archive.name + ".extracted"), ignore_errors=True
+                )
+                failed.add(archive)
+
+    tasks = []
+    for file in sorted(Path(path).rglob("*")):
+        if not file.is_file():
+            continue
+        extension = file.suffix.lower()
+        if extension in SUPPORTED_GEOSPATIAL_FORMATS:
+            tasks.append(("file", str(file)))
+        elif extension in SUPPORTED_ARCHIVE_FORMATS or file in failed:
+            # e.g. .7z or .rar, which are extracted by geoextent
+            directory = file.with_name(file.name + ".archive")
+            directory.mkdir()
+            file.rename(directory.joinpath(file.name))
+            tasks.append(("directory", str(directory)))
+
+    return tasks
+
+
+def merge_bboxes(bboxes: list) -> list | None:
+    """
+    Returns the bbox [minx, miny, maxx, maxy] which contains all (valid) bboxes.
+    """
+    bboxes = [
+        bbox
+        for bbox in bboxes
+        if bbox and len(bbox) == 4 and not any(math.isnan(x) for x in bbox)
+    ]
+    if not bboxes:
+        return None
+
+    return [
+        min(bbox[0] for bbox in bboxes),
+        min(bbox[1] for bbox in bboxes),
+        max(bbox[2] for bbox in bboxes),
+        max(bbox[3] for bbox in bboxes),
+    ]
+
+
+def run_per_file(
+    pool: GeoextentPool,
+    path: str,
+    timeout_geoextent: int,
+    timeout_process: int,
+    key: int,
+    memo=None,
+    timeout_model=None,
+    tmp_dir=None,
+) -> dict:
+    """
+    Fans the geospatial files (and extracted archive members) of a dataset out across the
+    pool, with the timeouts per file, and merges their bboxes into the dataset bbox.
+
+    memo: helper_file_extents.ExtentMemo to reuse the results of earlier runs
+    timeout_model: helper_timeout_model.TimeoutModel to predict the timeout of each file,
+                   the process timeout keeps its ratio to timeout_geoextent
+    tmp_dir: helper_staging.BudgetedDirectory of path (space for extracted archives)
+    """
+    tasks = get_geoextent_tasks(pool, path, timeout_process, key, tmp_dir)
+    if not tasks:
+        return {}
+    run = pool.run if memo is None else memo.run
+
+    def run_task(task):
+        mode, task_path = task
+        if timeout_model is None:
+            return run(task_path, timeout_geoextent, timeout_process, key, mode=mode)
+        timeout = timeout_model.get_timeout(task_path)
+        return run(
+            task_path,
+            timeout,
+            math.ceil(timeout * timeout_process / timeout_geoextent),
+            key,
+            mode=mode,
+        )
+
+    with ThreadPoolExecutor(max_workers=min(len(tasks), pool.processes)) as executor:
+        results = list(executor.map(run_task, tasks))
+
+    metadata = {}
+    bbox = merge_bboxes([result.get("bbox") for result in results])
+    if bbox:
+        metadata["bbox"] = bbox
+        metadata["crs"] = "4326"
+    timeouts = [result["timeout"] for result in results if result.get("timeout")]
+    if timeouts:
+        metadata["timeout"] = max(timeouts)
+
+    return metadata
@@ -1,6 +1,5 @@
 #!/usr/bin/python3
 
-import json
 import math
 import sqlite3
 from pathlib import Path
@@ -8,6 +7,10 @@ from pathlib import Path
 import geopandas as gpd
 from shapely.geometry import box, Point
 
+from helper_metadata_compression import register_metadata_functions
+from helper_sqlite_schema import BBOX_COLUMNS_VERSION
+from helper_sqlite_schema import check_schema_version
+
 
 def create_geopackage(
     sqlite_path: str, task: str = "bbox", filter: float = None
@@ -30,6 +33,8 @@ def create_geopackage(
 
     # Connect to SQLite database
     conn = sqlite3.connect(sqlite_path)
+    check_schema_version(conn, BBOX_COLUMNS_VERSION)
+    register_metadata_functions(conn)
     cursor = conn.cursor()
 
     cursor.execute(
@@ -54,7 +59,10 @@ def create_geopackage(
             download_flag,
             timeout,
             time_result_insert,
-            bbox
+            bbox_minx,
+            bbox_miny,
+            bbox_maxx,
+            bbox_maxy
         FROM datasets
         WHERE bbox is not NULL""",
     )
@@ -94,7 +102,7 @@ def create_geopackage(
             pass
 
         # Define the bounding box (xmin, ymin, xmax, ymax)
-        bbox = json.loads(dataset[19])
+        bbox = dataset[19:23]
 
         # Calculate area
         # ! not a good way to calculate the are
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+
+import json
+import re
+import sqlite3
+import struct
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard is optional, zlib (standard library) is always available
+    zstandard = None
+
+
+# Layout of a compressed metadata blob:
+#   1 byte   codec (b"z" = zlib, b"s" = zstd)
+#   4 bytes  id of the shared dictionary (big-endian, 0 = no dictionary)
+#   n bytes  compressed JSON
+HEADER = struct.Struct(">cI")
+CODECS = {"zlib": b"z", "zstd": b"s"}
+
+# zlib can only use the last 32 KiB of a preset dictionary
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+ZSTD_DICTIONARY_SIZE = 112 * 1024
+
+
+class MetadataCodec:
+    """
+    Compresses raw metadata records with shared dictionaries trained on provider responses
+    and decodes stored values transparently (JSON text and compressed blobs).
+    """
+
+    def __init__(self, dictionaries: dict | None = None, level: int = 9):
+        # {dictionary_id: (codec, content_provider, dictionary)}
+        self.dictionaries = dictionaries or {}
+        self.level = level
+        self.provider_dictionary = {
+            content_provider: dictionary_id
+            for dictionary_id, (_, content_provider, _) in self.dictionaries.items()
+        }
+        self._compressors = {}
+        self._decompressors = {}
+
+    @classmethod
+    def from_db(cls, conn: sqlite3.Connection, level: int = 9):
+        return cls(load_dictionaries(conn), level=level)
+
+    def encode(self, content_provider: str, metadata: dict) -> bytes | str:
+        """
+        Returns a compressed blob if a dictionary exists for the content provider,
+        otherwise the JSON text (as stored before).
+        """
+        dictionary_id = self.provider_dictionary.get(content_provider)
+        if dictionary_id is None:
+            return json.dumps(metadata)
+
+        codec, _, dictionary = self.dictionaries[dictionary_id]
+        data = json.dumps(metadata, separators=(",", ":")).encode("utf-8")
+
+        match codec:
+            case "zlib":
+                compressor = zlib.compressobj(self.level, zdict=dictionary)
+                payload = compressor.compress(data) + compressor.flush()
+            case "zstd":
+                if dictionary_id not in self._compressors:
+                    self._compressors[dictionary_id] = zstandard.ZstdCompressor(
+                        level=self.level,
+                        dict_data=(
+                            zstandard.ZstdCompressionDict(dictionary)
+                            if dictionary
+                            else None
+                        ),
+                    )
+                payload = self._compressors[dictionary_id].compress(data)
+
+        return HEADER.pack(CODECS[codec], dictionary_id) + payload
+
+    def decode(self, value: bytes | str | None) -> dict | None:
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return json.loads(value)
+
+        codec, dictionary_id = HEADER.unpack_from(value)
+        payload = memoryview(value)[HEADER.size :]
+        dictionary = self.dictionaries[dictionary_id][2] if dictionary_id else b""
+
+        match codec:
+            case b"z":
+                decompressor = (
+                    zlib.decompressobj(zdict=dictionary)
+                    if dictionary
+                    else zlib.decompressobj()
+                )
+                data = decompressor.decompress(payload) + decompressor.flush()
+            case b"s":
+                if zstandard is None:
+                    raise RuntimeError("zstandard is required to decode this metadata.")
+                if dictionary_id not in self._decompressors:
+                    self._decompressors[dictionary_id] = zstandard.ZstdDecompressor(
+                        dict_data=(
+                            zstandard.ZstdCompressionDict(dictionary)
+                            if dictionary
+                            else None
+                        )
+                    )
+                data = self._decompressors[dictionary_id].decompress(payload)
+            case _:
+                raise ValueError(f"Unknown metadata codec {codec!r}")
+
+        return json.loads(data)
+
+
+def train_dictionary(samples: list, codec: str = "zlib") -> bytes:
+    """
+    Returns a shared dictionary for a list of sample records (dicts) of one content provider.
+    An empty dictionary (e.g. too few samples for zstd) compresses without dictionary.
+    """
+    encoded = [
+        json.dumps(sample, separators=(",", ":")).encode("utf-8") for sample in samples
+    ]
+
+    match codec:
+        case "zstd":
+            if zstandard is None:
+                raise RuntimeError("zstandard is not installed, use codec 'zlib'.")
+            try:
+                return zstandard.train_dictionary(
+                    ZSTD_DICTIONARY_SIZE, encoded
+                ).as_bytes()
+            except zstandard.ZstdError as e:
+                # the trainer needs enough (and large enough) samples
+                print(f"No zstd dictionary trained ({e}), compressing without.")
+                return b""
+
+        case "zlib":
+            # zlib has no dictionary trainer: collect the keys and short values which occur
+            # in many records. The most valuable fragments are placed at the end, because
+            # zlib prefers short distances.
+            counter = Counter()
+            for data in encoded:
+                counter.update(set(re.findall(rb'"[^"]{1,64}":?', data)))
+
+            fragments = [
+                fragment
+                for fragment, count in counter.items()
+                if count > 1 and count >= len(encoded) // 20
+            ]
+            fragments.sort(key=lambda fragment: counter[fragment] * len(fragment))
+
+            dictionary = b""
+            for fragment in reversed(fragments):
+                if len(dictionary) + len(fragment) > ZLIB_DICTIONARY_SIZE:
+                    break
+                dictionary = fragment + dictionary
+            return dictionary
+
+        case _:
+            raise ValueError(f"Unsupported codec: {codec}")
+
+
+def create_dictionary_table(conn: sqlite3.Connection | sqlite3.Cursor):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metadata_dictionaries (
+            id INTEGER PRIMARY KEY,
+            content_provider TEXT,
+            codec TEXT,
+            dictionary BLOB
+        )
+    """)
+
+
+def save_dictionary(
+    conn: sqlite3.Connection, content_provider: str, codec: str, dictionary: bytes
+) -> int:
+    create_dictionary_table(conn)
+    cursor = conn.execute(
+        "INSERT INTO metadata_dictionaries (content_provider, codec, dictionary) VALUES (?, ?, ?)",
+        (content_provider, codec, dictionary),
+    )
+    return cursor.lastrowid
+
+
+def load_dictionaries(conn: sqlite3.Connection) -> dict:
+    try:
+        rows = conn.execute(
+            "SELECT id, codec, content_provider, dictionary FROM metadata_dictionaries ORDER BY id"
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # database without compressed metadata
+        return {}
+
+    # a later dictionary of the same content provider replaces the earlier one for encoding
+    return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+
+def register_metadata_functions(
+    conn: sqlite3.Connection, codec: MetadataCodec | None = None
+):
+    """
+    Registers the SQL function metadata_json(metadata), which returns the raw metadata as JSON text.
+    Readers of the datasets table call it on their connection, compressed metadata is
+    stored as blob.
+
+    Example: SELECT json_extract(metadata_json(metadata), '$.title') FROM datasets
+    """
+    if codec is None:
+        codec = MetadataCodec.from_db(conn)
+
+    def metadata_json(value):
+        if value is None or isinstance(value, str):
+            return value
+        return json.dumps(codec.decode(value))
+
+    conn.create_function("metadata_json", 1, metadata_json, deterministic=True)
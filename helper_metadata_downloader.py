@@ -8,6 +8,66 @@ from dateutil import parser
 from pathlib import Path
 
 
+# taken from https://github.com/ladrex/geoextent/blob/master/geoextent/__main__.py
+SUPPORTED_GEOSPATIAL_FORMATS = [
+    ".geojson",
+    ".csv",
+    ".geotiff",
+    ".tif",
+    ".tiff",
+    ".shp",
+    ".gpkg",
+    ".gpx",
+    ".gml",
+    ".kml",
+]
+
+# taken from https://pypi.org/project/patool/
+SUPPORTED_ARCHIVE_FORMATS = [
+    ".7z",
+    ".cb7",
+    ".ace",
+    ".cba",
+    ".adf",
+    ".alz",
+    ".ape",
+    ".a",
+    ".arc",
+    ".arj",
+    ".bz2",
+    ".bz3",
+    ".cab",
+    ".chm",
+    ".Z",
+    ".cpio",
+    ".deb",
+    ".dms",
+    ".flac",
+    ".gz)",
+    ".iso",
+    ".lrz",
+    ".lha",
+    ".lzh",
+    ".lz",
+    ".lzma",
+    ".lzo",
+    ".rpm",
+    ".rar",
+    ".cbr",
+    ".rz)",
+    ".shn",
+    ".tar",
+    ".cbt",
+    ".udf",
+    ".xz)",
+    ".zip",
+    ".jar",
+    ".cbz",
+    ".zoo",
+    ".zst",
+]
+
+
 def get_metadata(content_provider: str, identifier: str, access_token: dict = {}) -> dict | int | None:
     match content_provider:
         case "dryad":
@@ -325,64 +385,8 @@ def analyse_files(
     """
     Returns sum_size, files_types, download_flag (e.g. [123456, ["tif", "zip"], True])
     """
-    # taken from https://github.com/ladrex/geoextent/blob/master/geoextent/__main__.py
-    supported_geospatial_formats = [
-        ".geojson",
-        ".csv",
-        ".geotiff",
-        ".tif",
-        ".tiff",
-        ".shp",
-        ".gpkg",
-        ".gpx",
-        ".gml",
-        ".kml",
-    ]
-
-    # taken from https://pypi.org/project/patool/
-    supported_archive_formats = [
-        ".7z",
-        ".cb7",
-        ".ace",
-        ".cba",
-        ".adf",
-        ".alz",
-        ".ape",
-        ".a",
-        ".arc",
-        ".arj",
-        ".bz2",
-        ".bz3",
-        ".cab",
-        ".chm",
-        ".Z",
-        ".cpio",
-        ".deb",
-        ".dms",
-        ".flac",
-        ".gz)",
-        ".iso",
-        ".lrz",
-        ".lha",
-        ".lzh",
-        ".lz",
-        ".lzma",
-        ".lzo",
-        ".rpm",
-        ".rar",
-        ".cbr",
-        ".rz)",
-        ".shn",
-        ".tar",
-        ".cbt",
-        ".udf",
-        ".xz)",
-        ".zip",
-        ".jar",
-        ".cbz",
-        ".zoo",
-        ".zst",
-    ]
+    supported_geospatial_formats = SUPPORTED_GEOSPATIAL_FORMATS
+    supported_archive_formats = SUPPORTED_ARCHIVE_FORMATS
 
     sum_size = 0
     files_types = []
@@ -390,6 +394,28 @@ def analyse_files(
     download_flag = False
     files = []
 
+    for file in get_files(content_provider, metadata):
+        sum_size += file["size"]
+        files_types.append(file["extension"])
+        files.append([file["name"], file["url"]])
+
+        if file["extension"] in supported_geospatial_formats:
+            geospatial_flag = True
+        if file["extension"] in (
+            supported_geospatial_formats + supported_archive_formats
+        ):
+            download_flag = True
+
+    return sum_size, files_types, files, geospatial_flag, download_flag
+
+
+def get_files(content_provider: str, metadata: dict) -> list:
+    """
+    Returns the downloadable files of a dataset, e.g.
+    [{"name": "a.tif", "url": "https://...", "size": 123, "extension": ".tif", "checksum": "md5:..."}]
+    """
+    files = []
+
     match content_provider:
         case "dryad":
             if "stash:files" in metadata["files_embedded"]:
@@ -403,52 +429,46 @@ def analyse_files(
                     if link_download is None:
                         continue
 
-                    name = file["path"]
-                    link = "https://datadryad.org" + link_download["href"]
-                    sum_size += file["size"]
-                    extension = Path(file["path"]).suffix.lower()
-                    files_types.append(extension)
-                    files.append([name, link])
-
-                    if extension in supported_geospatial_formats:
-                        geospatial_flag = True
-                    if extension in (
-                        supported_geospatial_formats + supported_archive_formats
-                    ):
-                        download_flag = True
+                    files.append(
+                        {
+                            "name": file["path"],
+                            "url": "https://datadryad.org" + link_download["href"],
+                            "size": file["size"],
+                            "extension": Path(file["path"]).suffix.lower(),
+                            "checksum": (
+                                f"{file['digestType']}:{file['digest']}"
+                                if file.get("digest") and file.get("digestType")
+                                else None
+                            ),
+                        }
+                    )
 
         case "figshare":
             if "files" in metadata:
                 for file in metadata["files"]:
-                    name = file["name"]
-                    link = file["download_url"]
-                    sum_size += file["size"]
-                    extension = Path(file["name"]).suffix.lower()
-                    files_types.append(extension)
-                    files.append([name, link])
-
-                    if extension in supported_geospatial_formats:
-                        geospatial_flag = True
-                    if extension in (
-                        supported_geospatial_formats + supported_archive_formats
-                    ):
-                        download_flag = True
+                    md5 = file.get("computed_md5") or file.get("supplied_md5")
+                    files.append(
+                        {
+                            "name": file["name"],
+                            "url": file["download_url"],
+                            "size": file["size"],
+                            "extension": Path(file["name"]).suffix.lower(),
+                            "checksum": f"md5:{md5}" if md5 else None,
+                        }
+                    )
 
         case "zenodo":
             if "files" in metadata:
                 for file in metadata["files"]:
-                    name = Path(file["links"]["self"]).parent.name
-                    link = file["links"]["self"]
-                    sum_size += file["size"]
-                    extension = Path(file["key"]).suffix.lower()
-                    files_types.append(extension)
-                    files.append([name, link])
-
-                    if extension in supported_geospatial_formats:
-                        geospatial_flag = True
-                    if extension in (
-                        supported_geospatial_formats + supported_archive_formats
-                    ):
-                        download_flag = True
-
-    return sum_size, files_types, files, geospatial_flag, download_flag
+                    files.append(
+                        {
+                            "name": Path(file["links"]["self"]).parent.name,
+                            "url": file["links"]["self"],
+                            "size": file["size"],
+                            "extension": Path(file["key"]).suffix.lower(),
+                            # e.g. "md5:2942bfabb3d05332b66eb128e0842cff"
+                            "checksum": file.get("checksum"),
+                        }
+                    )
+
+    return files
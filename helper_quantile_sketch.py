@@ -0,0 +1,414 @@
+#!/usr/bin/python3
+
+import json
+import math
+import random
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from helper_sqlite_schema import migrate
+
+# groups of datasets for which a sketch of sum_size is kept per content provider
+SKETCH_FLAGS = {
+    "all": "1",
+    "download_flag": "download_flag = 1",
+    "geospatial_flag": "geospatial_flag = 1",
+}
+
+
+class KLLSketch:
+    """
+    KLL quantile sketch (Karnin, Lang, Liberty 2016, https://arxiv.org/abs/1603.05346).
+
+    Keeps O(k) values in compactors of growing weight. The normalised rank error of a
+    single quantile query is about rank_error() (99 % confidence). Sketches built on
+    disjoint parts of the data can be merged.
+    """
+
+    def __init__(self, k: int = 200, c: float = 2 / 3, seed: int | None = 0):
+        self.k = k
+        self.c = c
+        self.n = 0
+        self.min = None
+        self.max = None
+        self.compactors = [[]]
+        self._random = random.Random(seed)
+
+    def rank_error(self) -> float:
+        # empirical bound of the Apache DataSketches KLL sketch (single quantile query)
+        return 2.296 / self.k**0.9723
+
+    def _capacity(self, height: int) -> int:
+        depth = len(self.compactors) - height - 1
+        return max(2, math.ceil(self.k * self.c**depth))
+
+    def _size(self) -> int:
+        return sum(len(compactor) for compactor in self.compactors)
+
+    def _max_size(self) -> int:
+        return sum(self._capacity(height) for height in range(len(self.compactors)))
+
+    def update(self, value: float):
+        self.n += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.compactors[0].append(value)
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def extend(self, values):
+        for value in values:
+            self.update(value)
+
+    def _compress(self):
+        for height in range(len(self.compactors)):
+            if len(self.compactors[height]) >= self._capacity(height):
+                if height + 1 == len(self.compactors):
+                    self.compactors.append([])
+                compactor = sorted(self.compactors[height])
+                # an odd item stays on its level, so the total weight is preserved
+                self.compactors[height] = (
+                    [compactor.pop()] if len(compactor) % 2 else []
+                )
+                offset = self._random.randint(0, 1)
+                self.compactors[height + 1].extend(compactor[offset::2])
+
+                if self._size() < self._max_size():
+                    break
+
+    def merge(self, other: "KLLSketch"):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for height, compactor in enumerate(other.compactors):
+            self.compactors[height].extend(compactor)
+
+        self.n += other.n
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+        while self._size() >= self._max_size():
+            self._compress()
+
+    def _weighted_values(self) -> list:
+        return sorted(
+            (value, 2**height)
+            for height, compactor in enumerate(self.compactors)
+            for value in compactor
+        )
+
+    def quantile(self, q: float) -> float | None:
+        if self.n == 0:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+
+        weighted_values = self._weighted_values()
+        total_weight = sum(weight for _, weight in weighted_values)
+        cumulative_weight = 0
+        for value, weight in weighted_values:
+            cumulative_weight += weight
+            if cumulative_weight >= q * total_weight:
+                return value
+        return self.max
+
+    def rank(self, value: float) -> float:
+        """
+        Returns the estimated fraction of values <= value.
+        """
+        weighted_values = self._weighted_values()
+        total_weight = sum(weight for _, weight in weighted_values)
+        if total_weight == 0:
+            return 0.0
+        return sum(weight for v, weight in weighted_values if v <= value) / total_weight
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "k": self.k,
+                "c": self.c,
+                "n": self.n,
+                "min": self.min,
+                "max": self.max,
+                "compactors": self.compactors,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, text: str) -> "KLLSketch":
+        data = json.loads(text)
+        sketch = cls(k=data["k"], c=data["c"])
+        sketch.n = data["n"]
+        sketch.min = data["min"]
+        sketch.max = data["max"]
+        sketch.compactors = data["compactors"]
+        return sketch
+
+
+def add_to_sketches(
+    sketches: dict,
+    content_provider: str,
+    sum_size: int,
+    flags: list,
+    k: int = 200,
+    seed: int | None = 0,
+):
+    """
+    Adds sum_size to the sketches {(content_provider, flag): KLLSketch} of the groups
+    with a true value in flags (same order as SKETCH_FLAGS).
+    """
+    for flag, value in zip(SKETCH_FLAGS, flags):
+        if value:
+            if (content_provider, flag) not in sketches:
+                sketches[(content_provider, flag)] = KLLSketch(k=k, seed=seed)
+            sketches[(content_provider, flag)].update(sum_size)
+
+
+def get_metadata_flags(normalized_metadata: dict) -> list:
+    # values of SKETCH_FLAGS for a harvested record (helper_metadata_downloader)
+    return [
+        True,
+        normalized_metadata["download_flag"],
+        normalized_metadata["geospatial_flag"],
+    ]
+
+
+def build_sketches(
+    sqlite_path: str,
+    first_key: int,
+    last_key: int,
+    k: int = 200,
+    watermarks: dict | None = None,
+) -> dict:
+    """
+    Returns {(content_provider, flag): KLLSketch} of sum_size for the datasets with
+    first_key < key <= last_key (one shard), without the datasets of a content provider
+    up to its watermark (already in the persisted sketches).
+    """
+    watermarks = watermarks or {}
+
+    conn = sqlite3.connect(sqlite_path)
+    cursor = conn.execute(
+        f"""
+        SELECT key, content_provider, sum_size, {", ".join(SKETCH_FLAGS.values())}
+        FROM datasets
+        WHERE key > ? AND key <= ? AND sum_size IS NOT NULL
+        """,
+        (first_key, last_key),
+    )
+
+    sketches = {}
+    while rows := cursor.fetchmany(10000):
+        for key, content_provider, sum_size, *flags in rows:
+            if key > watermarks.get(content_provider, 0):
+                add_to_sketches(
+                    sketches, content_provider, sum_size, flags, k=k, seed=first_key
+                )
+
+    conn.close()
+    return sketches
+
+
+def load_sketches(conn: sqlite3.Connection) -> tuple[dict, dict]:
+    """
+    Returns the persisted sketches and per content provider the highest dataset key
+    they contain.
+    """
+    sketches = {}
+    watermarks = {}
+    for content_provider, flag, sketch, sketch_max_key in conn.execute(
+        "SELECT content_provider, flag, sketch, max_key FROM quantile_sketches"
+    ):
+        sketches[(content_provider, flag)] = KLLSketch.from_json(sketch)
+        watermarks[content_provider] = max(
+            watermarks.get(content_provider, 0), sketch_max_key
+        )
+    return sketches, watermarks
+
+
+def update_sketches(sqlite_path: str, shards: int = 1, k: int = 200) -> dict:
+    """
+    Adds all datasets which were inserted since the last update to the persisted sketches.
+    The new datasets are split into key ranges, which are sketched in parallel (shards > 1)
+    and merged. Content providers whose sketches were dropped by a changed row (triggers
+    in helper_sqlite_schema) are rebuilt from all their datasets.
+    """
+    time_begin = time.time()
+
+    conn = sqlite3.connect(sqlite_path)
+    migrate(conn)
+    sketches, watermarks = load_sketches(conn)
+    last_key = conn.execute("SELECT MAX(key) FROM datasets").fetchone()[0] or 0
+    providers = [
+        row[0]
+        for row in conn.execute(
+            "SELECT DISTINCT content_provider FROM datasets WHERE sum_size IS NOT NULL"
+        )
+    ]
+    max_key = min(
+        (watermarks.get(provider, 0) for provider in providers), default=last_key
+    )
+
+    if last_key > max_key:
+        bounds = [
+            max_key + (last_key - max_key) * shard // shards
+            for shard in range(shards + 1)
+        ]
+        if shards > 1:
+            with ProcessPoolExecutor(max_workers=shards) as executor:
+                results = list(
+                    executor.map(
+                        build_sketches,
+                        [sqlite_path] * shards,
+                        bounds[:-1],
+                        bounds[1:],
+                        [k] * shards,
+                        [watermarks] * shards,
+                    )
+                )
+        else:
+            results = [build_sketches(sqlite_path, max_key, last_key, k, watermarks)]
+
+        for shard_sketches in results:
+            for group, sketch in shard_sketches.items():
+                if group in sketches:
+                    sketches[group].merge(sketch)
+                else:
+                    sketches[group] = sketch
+
+        conn.executemany(
+            "INSERT OR REPLACE INTO quantile_sketches (content_provider, flag, sketch, max_key) VALUES (?, ?, ?, ?)",
+            [
+                (content_provider, flag, sketch.to_json(), last_key)
+                for (content_provider, flag), sketch in sketches.items()
+            ],
+        )
+        conn.commit()
+
+        print(
+            f"Updated quantile sketches with datasets {max_key + 1} to {last_key} "
+            + f"in {time.time() - time_begin:.1f} s."
+        )
+
+    conn.close()
+    return sketches
+
+
+def save_sketches_file(sketches: dict, path: str):
+    """
+    Writes the sketches to a JSON file, e.g. the sketches of the metadata harvester next
+    to its checkpoint.
+    """
+    data = {}
+    for (content_provider, flag), sketch in sketches.items():
+        data.setdefault(content_provider, {})[flag] = sketch.to_json()
+
+    part_path = Path(path).with_name(Path(path).name + ".part")
+    with open(part_path, "w") as file:
+        json.dump(data, file)
+    part_path.replace(path)
+
+
+def load_sketches_file(path: str) -> dict:
+    if not Path(path).is_file():
+        return {}
+
+    with open(path) as file:
+        data = json.load(file)
+    return {
+        (content_provider, flag): KLLSketch.from_json(sketch)
+        for content_provider, flags in data.items()
+        for flag, sketch in flags.items()
+    }
+
+
+def seed_sketches(sqlite_path: str, sketch_paths: list) -> bool:
+    """
+    Persists the merged sketches of the metadata harvester (sketch files) as the sketches
+    of all datasets in the database, e.g. right after convert_tinydb_to_sqlite3. Nothing
+    is written if sketches are already persisted or the number of values per group does
+    not match the datasets (e.g. a crash of the harvester between the TinyDB insert and
+    the sketch file), update_sketches then builds them from the database.
+    """
+    sketches = {}
+    for path in sketch_paths:
+        for group, sketch in load_sketches_file(path).items():
+            if group in sketches:
+                sketches[group].merge(sketch)
+            else:
+                sketches[group] = sketch
+
+    conn = sqlite3.connect(sqlite_path)
+    if conn.execute("SELECT 1 FROM quantile_sketches LIMIT 1").fetchone():
+        conn.close()
+        return False
+
+    counts = {}
+    for content_provider, *flag_counts in conn.execute(f"""
+        SELECT content_provider, {", ".join(f"SUM({value})" for value in SKETCH_FLAGS.values())}
+        FROM datasets
+        WHERE sum_size IS NOT NULL
+        GROUP BY content_provider
+        """):
+        for flag, count in zip(SKETCH_FLAGS, flag_counts):
+            if count:
+                counts[(content_provider, flag)] = count
+
+    if counts != {group: sketch.n for group, sketch in sketches.items()}:
+        print("Harvester sketches do not match the datasets, not used.")
+        conn.close()
+        return False
+
+    last_key = conn.execute("SELECT MAX(key) FROM datasets").fetchone()[0] or 0
+    conn.executemany(
+        "INSERT INTO quantile_sketches (content_provider, flag, sketch, max_key) VALUES (?, ?, ?, ?)",
+        [
+            (content_provider, flag, sketch.to_json(), last_key)
+            for (content_provider, flag), sketch in sketches.items()
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+    print(f"Seeded quantile sketches from {len(sketch_paths)} harvester sketch files.")
+    return True
+
+
+def get_quantile(
+    sketches: dict,
+    q: float,
+    content_provider: str | None = None,
+    flag: str = "download_flag",
+) -> tuple[float | None, float]:
+    """
+    Returns the q-quantile of sum_size and its normalised rank error. Without
+    content_provider, the sketches of all content providers are merged.
+    """
+    selected = [
+        provider_sketch
+        for (provider, sketch_flag), provider_sketch in sketches.items()
+        if sketch_flag == flag and content_provider in (None, provider)
+    ]
+    # the error bound of the merged sketch is that of the smallest k
+    sketch = KLLSketch(k=min((s.k for s in selected), default=200))
+    for provider_sketch in selected:
+        sketch.merge(provider_sketch)
+
+    return sketch.quantile(q), sketch.rank_error()
+
+
+if __name__ == "__main__":
+    sqlite_path = "/home/lars/FINAL_metadata_db.sqlite3"
+
+    sketches = update_sketches(sqlite_path, shards=4)
+    for name in ["dryad", "figshare", "zenodo"]:
+        value, error = get_quantile(sketches, 0.95, name)
+        if value is not None:
+            print(
+                f"{name.title()}: 0,95-Quantil {value / 1024**3:.2f} GiB "
+                + f"(rank error ±{error * 100:.2f} %)"
+            )
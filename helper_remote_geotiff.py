@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+import sqlite3
+
+import requests
+from osgeo import gdal
+from osgeo import osr
+
+from helper_archive_probe import RangeNotSupported
+from helper_archive_probe import fetch_range
+
+gdal.UseExceptions()
+
+REMOTE_GEOTIFF_FORMATS = [".tif", ".tiff", ".geotiff"]
+
+# only the requests for the header (and GeoKeys) are sent, no directory listing. The
+# download URLs of the providers do not end with the extension (e.g. Zenodo
+# .../files/x.tif/content, figshare .../files/<id>), /vsicurl/ is restricted to the
+# exact URL instead (CPL_VSIL_CURL_ALLOWED_FILENAME). Without retries of GDAL, all
+# requests are paced by the caller (wait).
+GDAL_VSICURL_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "GDAL_HTTP_TIMEOUT": "60",
+    "GDAL_HTTP_MAX_RETRY": "0",
+    "GDAL_INGESTED_BYTES_AT_OPEN": "65536",
+}
+
+
+def supports_range(session: requests.Session, url: str) -> bool:
+    try:
+        fetch_range(session, url, "0-0")
+    except (RangeNotSupported, requests.RequestException):
+        return False
+    return True
+
+
+def get_vsicurl_options(url: str) -> dict:
+    return {**GDAL_VSICURL_OPTIONS, "CPL_VSIL_CURL_ALLOWED_FILENAME": f"/vsicurl/{url}"}
+
+
+def remote_geotiff_bbox(url: str) -> list | None:
+    """
+    Returns the bbox [minx, miny, maxx, maxy] (EPSG:4326) of a remote GeoTIFF, read with
+    GDAL /vsicurl/ from the header only, or None if the file has no georeference.
+    """
+    options = get_vsicurl_options(url)
+    for key, value in options.items():
+        gdal.SetThreadLocalConfigOption(key, value)
+
+    try:
+        dataset = gdal.Open(f"/vsicurl/{url}")
+        projection = dataset.GetProjection()
+        if not projection:
+            return None
+        x_origin, x_size, x_rotation, y_origin, y_rotation, y_size = (
+            dataset.GetGeoTransform()
+        )
+        width, height = dataset.RasterXSize, dataset.RasterYSize
+    finally:
+        for key in options:
+            gdal.SetThreadLocalConfigOption(key, None)
+
+    corners = [
+        (
+            x_origin + column * x_size + row * x_rotation,
+            y_origin + column * y_rotation + row * y_size,
+        )
+        for column, row in [(0, 0), (width, 0), (0, height), (width, height)]
+    ]
+
+    source = osr.SpatialReference()
+    source.ImportFromWkt(projection)
+    source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(4326)
+    target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transformation = osr.CoordinateTransformation(source, target)
+
+    points = [transformation.TransformPoint(x, y)[:2] for x, y in corners]
+    return [
+        min(point[0] for point in points),
+        min(point[1] for point in points),
+        max(point[0] for point in points),
+        max(point[1] for point in points),
+    ]
+
+
+def probe_remote_geotiff(session: requests.Session, url: str, wait=None) -> list | None:
+    """
+    Returns the bbox of a remote GeoTIFF, or None if it has to be downloaded (no range
+    support, no georeference or error).
+
+    wait: called before the requests, e.g. the rate limit of the content provider
+    """
+    if wait is not None:
+        wait()
+    if not supports_range(session, url):
+        return None
+
+    if wait is not None:
+        # the header is read with one request (GDAL_INGESTED_BYTES_AT_OPEN)
+        wait()
+    try:
+        return remote_geotiff_bbox(url)
+    except Exception as e:
+        print(f"DEBUG: Exception remote GeoTIFF {url}:", e)
+        return None
+
+
+def probe_database_geotiffs(sqlite_path: str, limit: int = 5):
+    """
+    Reads the bbox of (up to limit) GeoTIFFs per content provider with their download
+    URLs, e.g. to check GDAL /vsicurl/ with URLs without the file extension.
+    """
+    conn = sqlite3.connect(sqlite_path)
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""
+        SELECT content_provider, url FROM (
+            SELECT datasets.content_provider, dataset_files.url,
+                ROW_NUMBER() OVER (
+                    PARTITION BY datasets.content_provider ORDER BY dataset_files.id
+                ) AS number
+            FROM dataset_files JOIN datasets ON datasets.key = dataset_files.dataset_key
+            WHERE dataset_files.extension IN ({", ".join("?" * len(REMOTE_GEOTIFF_FORMATS))})
+        )
+        WHERE number <= ?
+        """,
+        (*REMOTE_GEOTIFF_FORMATS, limit),
+    )
+    rows = cursor.fetchall()
+    conn.close()
+
+    session = requests.Session()
+    for content_provider, url in rows:
+        print(content_provider, url, probe_remote_geotiff(session, url))
+
+
+if __name__ == "__main__":
+    sqlite_path = "/home/lars/FINAL_metadata_db.sqlite3"
+
+    probe_database_geotiffs(sqlite_path)
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from helper_archive_probe import get_download_flag
+from helper_convert_tinydb_to_sqlite3 import NORMALIZED_COLUMNS
+from helper_convert_tinydb_to_sqlite3 import get_normalized_row
+from helper_metadata_compression import MetadataCodec
+from helper_metadata_compression import load_dictionaries
+from helper_metadata_downloader import get_files
+from helper_metadata_downloader import get_normalized_metadata
+from helper_sqlite_schema import INSERT_DATASET_FILE_QUERY
+from helper_sqlite_schema import get_dataset_file_rows
+from helper_sqlite_schema import migrate
+
+# set in each process of the pool by _init_worker
+_codec = None
+
+
+def _init_worker(dictionaries: dict):
+    global _codec
+    _codec = MetadataCodec(dictionaries)
+
+
+def _renormalize_chunk(rows: list) -> list:
+    """
+    Returns [(*new_values, key), ...] for all rows whose normalised columns change and
+    the new rows of dataset_files for these datasets.
+    """
+    changed = []
+    file_rows = []
+
+    for key, metadata, archive_probe, *current_row in rows:
+        content_provider = current_row[0]
+        metadata = _codec.decode(metadata)
+        normalized_metadata = get_normalized_metadata(content_provider, metadata)
+        if normalized_metadata is None:
+            continue
+
+        # keep zip files without geospatial members (helper_archive_probe) excluded
+        if archive_probe and normalized_metadata["download_flag"]:
+            normalized_metadata["download_flag"] = get_download_flag(
+                normalized_metadata["files"], json.loads(archive_probe)
+            )
+
+        new_row = get_normalized_row(normalized_metadata)
+        if new_row != tuple(current_row):
+            changed.append((*new_row[1:], key))
+            file_rows.extend(
+                get_dataset_file_rows(key, get_files(content_provider, metadata))
+            )
+
+    return changed, file_rows
+
+
+def renormalize_metadata(
+    sqlite_path: str,
+    chunk_size: int = 2000,
+    commit_interval: int = 50000,
+    processes: int | None = None,
+):
+    """
+    Recomputes the normalised columns of all datasets from the stored raw metadata
+    (e.g. after a change of get_normalized_metadata or analyse_files) without any
+    network access. Only rows whose normalised values change are written.
+    """
+    time_begin = time.time()
+
+    conn = sqlite3.connect(sqlite_path)
+    migrate(conn)
+    cursor = conn.cursor()
+
+    select_query = f"""
+        SELECT key, metadata, archive_probe, {", ".join(NORMALIZED_COLUMNS)}
+        FROM datasets
+        WHERE key > ?
+        ORDER BY key
+        LIMIT ?
+    """
+    # content_provider is the source of the normalisation and never changes
+    update_query = f"""
+        UPDATE datasets
+        SET {", ".join(f"{column} = ?" for column in NORMALIZED_COLUMNS[1:])}
+        WHERE key = ?
+    """
+
+    total = cursor.execute("SELECT COUNT(*) FROM datasets").fetchone()[0]
+    counter_read = 0
+    counter_changed = 0
+    pending_updates = []
+    pending_file_rows = []
+
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=_init_worker,
+        initargs=(load_dictionaries(conn),),
+    ) as executor:
+        last_key = 0
+        futures = []
+        max_pending_chunks = 2 * (processes or os.cpu_count())
+
+        while True:
+            rows = cursor.execute(select_query, (last_key, chunk_size)).fetchall()
+            if rows:
+                last_key = rows[-1][0]
+                counter_read += len(rows)
+                futures.append(executor.submit(_renormalize_chunk, rows))
+
+            # collect results in order, keep a bounded number of chunks in flight
+            while futures and (not rows or len(futures) >= max_pending_chunks):
+                changed, file_rows = futures.pop(0).result()
+                pending_updates.extend(changed)
+                pending_file_rows.extend(file_rows)
+
+                if len(pending_updates) >= commit_interval:
+                    write_updates(
+                        cursor, update_query, pending_updates, pending_file_rows
+                    )
+                    conn.commit()
+                    counter_changed += len(pending_updates)
+                    pending_updates = []
+                    pending_file_rows = []
+
+            print(
+                f"\r\033[KRe-normalised {counter_read}/{total} datasets, "
+                + f"{counter_changed + len(pending_updates)} changed.",
+                end="",
+            )
+
+            if not rows:
+                break
+
+    write_updates(cursor, update_query, pending_updates, pending_file_rows)
+    conn.commit()
+    counter_changed += len(pending_updates)
+    conn.close()
+
+    time_str = time.strftime("%H:%M:%S", time.gmtime(time.time() - time_begin))
+    print(f"\nFinished re-normalisation of {counter_changed} datasets in {time_str}")
+
+
+def write_updates(
+    cursor: sqlite3.Cursor, update_query: str, updates: list, file_rows: list
+):
+    cursor.executemany(update_query, updates)
+    # replace the files of all changed datasets
+    cursor.executemany(
+        "DELETE FROM dataset_files WHERE dataset_key = ?",
+        [(update[-1],) for update in updates],
+    )
+    cursor.executemany(INSERT_DATASET_FILE_QUERY, file_rows)
+
+
+if __name__ == "__main__":
+    sqlite_path = "/home/lars/FINAL_metadata_db.sqlite3"
+
+    renormalize_metadata(sqlite_path)
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+import hashlib
+import json
+import shutil
+import threading
+from pathlib import Path
+
+# <file>.part is the partial download, <file>.part.json its state (url, validators)
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".part.json"
+STAGING_PREFIX = "dataset_"
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_staging_name(key: int) -> str:
+    # deterministic, a later run continues the downloads of the same dataset
+    return f"{STAGING_PREFIX}{key}"
+
+
+def _part_path(filepath: Path) -> Path:
+    return filepath.with_name(filepath.name + PART_SUFFIX)
+
+
+def _state_path(filepath: Path) -> Path:
+    return filepath.with_name(filepath.name + STATE_SUFFIX)
+
+
+def is_complete(filepath: Path) -> bool:
+    # a file only gets its final name after it was downloaded and validated
+    return (
+        filepath.is_file()
+        and not _part_path(filepath).exists()
+        and not _state_path(filepath).exists()
+    )
+
+
+def has_partial(filepath: Path) -> bool:
+    return _part_path(filepath).exists()
+
+
+def discard_partial(filepath: Path):
+    _part_path(filepath).unlink(missing_ok=True)
+    _state_path(filepath).unlink(missing_ok=True)
+
+
+def get_resume_headers(filepath: Path, url: str) -> dict:
+    """
+    Returns the Range and If-Range headers to continue a partial download, or {} if the
+    download has to start from the beginning.
+    """
+    part_path = _part_path(filepath)
+    state_path = _state_path(filepath)
+    if not part_path.is_file() or not state_path.is_file():
+        discard_partial(filepath)
+        return {}
+
+    try:
+        state = json.loads(state_path.read_text())
+    except (OSError, ValueError):
+        state = {}
+    validator = state.get("etag") or state.get("last_modified")
+    offset = part_path.stat().st_size
+
+    if state.get("url") != url or not validator or offset == 0:
+        discard_partial(filepath)
+        return {}
+
+    # If-Range: the server sends the whole file (200) if it has changed
+    return {"Range": f"bytes={offset}-", "If-Range": validator}
+
+
+def _write_state(resp, filepath: Path, url: str):
+    etag = resp.headers.get("etag")
+    _state_path(filepath).write_text(
+        json.dumps(
+            {
+                "url": url,
+                # weak ETags cannot be used with If-Range
+                "etag": etag if etag and not etag.startswith("W/") else None,
+                "last_modified": resp.headers.get("last-modified"),
+            }
+        )
+    )
+
+
+def tee_response(resp, filepath: Path, url: str):
+    """
+    Yields the chunks of a (full) response and writes them to <file>.part, e.g. for
+    helper_streaming_extract: if the extraction stops, the download continues from the
+    received bytes.
+    """
+    _write_state(resp, filepath, url)
+    with open(_part_path(filepath), "wb") as dst:
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            dst.write(chunk)
+            yield chunk
+
+
+def write_response(
+    resp, filepath: Path, url: str, stop_event: threading.Event | None = None
+) -> bool:
+    """
+    Writes the body of a (partial) response to <file>.part. Returns False if stop_event
+    was set, the partial download is kept for a later run.
+    """
+    part_path = _part_path(filepath)
+    offset = 0
+
+    if resp.status_code == 206:
+        # Content-Range: bytes 1000-146514/146515
+        content_range = resp.headers.get("content-range", "")
+        start = content_range.removeprefix("bytes ").partition("-")[0]
+        offset = part_path.stat().st_size if part_path.is_file() else 0
+        if not start.isdigit() or int(start) != offset:
+            resp.close()
+            discard_partial(filepath)
+            raise ValueError(f"Unexpected Content-Range: {content_range}")
+    else:
+        _write_state(resp, filepath, url)
+
+    with open(part_path, "ab" if offset else "wb") as dst:
+        for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+            dst.write(chunk)
+            if stop_event is not None and stop_event.is_set():
+                resp.close()
+                return False
+
+    return True
+
+
+def validate_file(filepath: Path, size: int | None, checksum: str | None) -> bool:
+    """
+    Compares the partial download with the size and checksum ("md5:...") of the
+    provider. Unknown hash algorithms are not checked.
+    """
+    part_path = _part_path(filepath)
+    if size is not None and part_path.stat().st_size != size:
+        return False
+    if not checksum or ":" not in checksum:
+        return True
+
+    algorithm, _, digest = checksum.partition(":")
+    try:
+        hash_object = hashlib.new(algorithm.lower().replace("-", ""))
+    except ValueError:
+        return True
+
+    with open(part_path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hash_object.update(chunk)
+
+    return hash_object.hexdigest() == digest.lower()
+
+
+def finish_download(filepath: Path):
+    _part_path(filepath).rename(filepath)
+    _state_path(filepath).unlink(missing_ok=True)
+
+
+def cleanup_orphans(parent: str, pending_keys: set) -> tuple[int, int]:
+    """
+    Removes the staging directories of earlier runs which are no longer needed (dataset
+    processed or not queued, temp directories of tempfile). The directories of pending
+    datasets are kept and continued. Returns (reused, removed).
+    """
+    reused = 0
+    removed = 0
+    if not Path(parent).is_dir():
+        return reused, removed
+
+    for path in Path(parent).iterdir():
+        if not path.is_dir():
+            continue
+        key = path.name.removeprefix(STAGING_PREFIX)
+        if path.name.startswith(STAGING_PREFIX) and key.isdigit():
+            if int(key) in pending_keys:
+                reused += 1
+                continue
+        elif not path.name.startswith("tmp"):
+            # not created by threaded_dataset_analysis
+            continue
+
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+
+    return reused, removed
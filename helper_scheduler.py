@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+import heapq
+import itertools
+import json
+import math
+import queue
+import sqlite3
+
+from helper_metadata_downloader import SUPPORTED_ARCHIVE_FORMATS
+from helper_metadata_downloader import SUPPORTED_GEOSPATIAL_FORMATS
+
+# weight of the prior (success rate of the geospatial_flag group) in processed datasets
+PRIOR_WEIGHT = 5
+
+# success rates before any dataset is processed, per geospatial_flag and for extensions
+# without processed datasets (archives may contain anything)
+DEFAULT_FLAG_RATES = {0: 0.05, 1: 0.5}
+DEFAULT_GEOSPATIAL_RATE = 0.5
+DEFAULT_ARCHIVE_RATE = 0.1
+
+# expected time of a dataset: requests, 1 s sleep per file and the download itself
+DATASET_SECONDS = 5
+FILE_SECONDS = 1
+BYTES_PER_SECOND = 10 * 1024**2
+
+
+class PriorityTaskQueue(queue.PriorityQueue):
+    """
+    Queue of download tasks, highest priority first. put((priority, task)) adds a
+    task, put(None) a sentinel, which is returned after all tasks.
+    """
+
+    def _init(self, maxsize: int):
+        super()._init(maxsize)
+        # insertion order for tasks of the same priority, tasks are not compared
+        self._counter = itertools.count()
+
+    def _put(self, item):
+        if item is None:
+            entry = (math.inf, next(self._counter), None)
+        else:
+            priority, task = item
+            entry = (-priority, next(self._counter), task)
+        heapq.heappush(self.queue, entry)
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+
+def get_success_rates(cursor: sqlite3.Cursor) -> tuple[dict, dict]:
+    """
+    Returns the observed share of processed datasets with bbox per geospatial_flag and
+    per file extension (geospatial and archive formats only), e.g.
+    ({0: 0.05, 1: 0.4}, {".tif": (0.62, 120), ...}) with the number of datasets.
+    A bbox is attributed to every extension of its dataset.
+    """
+    cursor.execute("""
+        SELECT geospatial_flag, COUNT(*), SUM(bbox IS NOT NULL)
+        FROM datasets
+        WHERE processed_flag = 1
+        GROUP BY geospatial_flag
+    """)
+    flag_rates = {
+        flag or 0: with_bbox / count for flag, count, with_bbox in cursor.fetchall()
+    }
+
+    cursor.execute("""
+        SELECT extension, COUNT(*), SUM(with_bbox)
+        FROM (
+            SELECT DISTINCT dataset_files.dataset_key, dataset_files.extension,
+                datasets.bbox IS NOT NULL AS with_bbox
+            FROM dataset_files JOIN datasets ON datasets.key = dataset_files.dataset_key
+            WHERE datasets.processed_flag = 1
+        )
+        GROUP BY extension
+    """)
+    supported = SUPPORTED_GEOSPATIAL_FORMATS + SUPPORTED_ARCHIVE_FORMATS
+    extension_rates = {
+        extension: (with_bbox / count, count)
+        for extension, count, with_bbox in cursor.fetchall()
+        if extension in supported
+    }
+
+    return flag_rates, extension_rates
+
+
+def expected_bbox(
+    files_types: list,
+    geospatial_flag: int,
+    flag_rates: dict,
+    extension_rates: dict,
+) -> float:
+    """
+    Probability that the dataset gets a bbox: at least one of its (supported) extensions
+    succeeds, their success rates are shrunk to the rate of its geospatial_flag group.
+    Groups and extensions without processed datasets use the default rates, so a new
+    database also prefers small datasets with geospatial files.
+    """
+    supported = SUPPORTED_GEOSPATIAL_FORMATS + SUPPORTED_ARCHIVE_FORMATS
+    flag = geospatial_flag or 0
+    prior = flag_rates.get(flag, DEFAULT_FLAG_RATES.get(flag, DEFAULT_FLAG_RATES[0]))
+
+    probability_none = 1.0
+    for extension in set(files_types) & set(supported):
+        if extension in SUPPORTED_GEOSPATIAL_FORMATS:
+            default_rate = DEFAULT_GEOSPATIAL_RATE
+        else:
+            default_rate = DEFAULT_ARCHIVE_RATE
+        # the default rate counts like PRIOR_WEIGHT processed datasets
+        rate, count = extension_rates.get(extension, (default_rate, PRIOR_WEIGHT))
+        rate = (rate * count + prior * PRIOR_WEIGHT) / (count + PRIOR_WEIGHT)
+        probability_none *= 1 - rate
+
+    return 1 - probability_none
+
+
+def expected_seconds(sum_size: int | None, file_count: int) -> float:
+    return (
+        DATASET_SECONDS + FILE_SECONDS * file_count + (sum_size or 0) / BYTES_PER_SECOND
+    )
+
+
+def get_priority(
+    files_types: str | None,
+    geospatial_flag: int,
+    sum_size: int | None,
+    file_count: int,
+    flag_rates: dict,
+    extension_rates: dict,
+) -> float:
+    """
+    Expected bboxes per second of a dataset, the download worker processes the
+    datasets with the highest value first.
+    """
+    return expected_bbox(
+        json.loads(files_types or "[]"), geospatial_flag, flag_rates, extension_rates
+    ) / expected_seconds(sum_size, file_count)
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+import sqlite3
+
+from helper_metadata_compression import register_metadata_functions
+from helper_sqlite_schema import SPATIAL_INDEX_VERSION
+from helper_sqlite_schema import check_schema_version
+
+
+def update_spatial_index(cursor: sqlite3.Cursor, key: int, bbox: list | None):
+    """
+    Writes the bbox [minx, miny, maxx, maxy] of a dataset into the R*Tree datasets_rtree,
+    or removes the dataset if it has no (valid) bbox.
+    """
+    if bbox and bbox[0] <= bbox[2] and bbox[1] <= bbox[3]:
+        cursor.execute(
+            "INSERT OR REPLACE INTO datasets_rtree (key, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)",
+            (key, bbox[0], bbox[2], bbox[1], bbox[3]),
+        )
+    else:
+        cursor.execute("DELETE FROM datasets_rtree WHERE key = ?", (key,))
+
+
+def update_spatial_index_many(cursor: sqlite3.Cursor, bboxes: list):
+    """
+    update_spatial_index for a list of (key, bbox | None).
+    """
+    valid = [
+        (key, bbox[0], bbox[2], bbox[1], bbox[3])
+        for key, bbox in bboxes
+        if bbox and bbox[0] <= bbox[2] and bbox[1] <= bbox[3]
+    ]
+    cursor.executemany(
+        "INSERT OR REPLACE INTO datasets_rtree (key, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)",
+        valid,
+    )
+    valid_keys = {row[0] for row in valid}
+    cursor.executemany(
+        "DELETE FROM datasets_rtree WHERE key = ?",
+        [(key,) for key, _ in bboxes if key not in valid_keys],
+    )
+
+
+class DatasetSpatialIndex:
+    """
+    Spatial queries over the bboxes of the analysed datasets.
+
+    Example:
+        index = DatasetSpatialIndex(sqlite_path)
+        index.datasets_intersecting(5.8, 47.2, 15.1, 55.1, provider="zenodo")
+    """
+
+    def __init__(self, sqlite_path: str):
+        self.conn = sqlite3.connect(sqlite_path)
+        check_schema_version(self.conn, SPATIAL_INDEX_VERSION)
+        register_metadata_functions(self.conn)
+
+    def datasets_intersecting(
+        self,
+        minx: float,
+        miny: float,
+        maxx: float,
+        maxy: float,
+        provider: str | None = None,
+    ) -> list:
+        """
+        Returns [(key, content_provider, doi, [minx, miny, maxx, maxy]), ...] of all
+        datasets whose bbox intersects the given bbox.
+        """
+        # the R*Tree stores 32 bit floats rounded outwards, the bbox columns are exact
+        query = """
+            SELECT datasets.key, content_provider, doi, bbox_minx, bbox_miny, bbox_maxx, bbox_maxy
+            FROM datasets_rtree JOIN datasets ON datasets.key = datasets_rtree.key
+            WHERE datasets_rtree.maxx >= :minx AND datasets_rtree.minx <= :maxx
+                AND datasets_rtree.maxy >= :miny AND datasets_rtree.miny <= :maxy
+                AND bbox_maxx >= :minx AND bbox_minx <= :maxx
+                AND bbox_maxy >= :miny AND bbox_miny <= :maxy
+        """
+        params = {"minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy}
+        if provider:
+            query += " AND content_provider = :provider"
+            params["provider"] = provider
+
+        return [
+            (key, content_provider, doi, list(bbox))
+            for key, content_provider, doi, *bbox in self.conn.execute(query, params)
+        ]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,460 @@
+#!/usr/bin/python3
+
+import sqlite3
+import time
+from pathlib import Path
+
+from helper_metadata_compression import MetadataCodec
+from helper_metadata_compression import create_dictionary_table
+from helper_metadata_downloader import get_files
+
+# The schema version of a database is stored in PRAGMA user_version.
+# Each migration brings a database from version n - 1 to version n (index + 1 in
+# SCHEMA_MIGRATIONS). Migrations must also work on databases which were created
+# before the migration existed (version 0).
+
+
+def _migration_base_tables(cursor: sqlite3.Cursor):
+    # tables of helper_convert_tinydb_to_sqlite3
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS statistics_dataset_analysis (
+            id INTEGER PRIMARY KEY,
+            content_provider TEXT,
+            processed_counter INTEGER,
+            processed_data_volume INTEGER,
+            timeout_counter INTEGER,
+            with_bbox INTEGER
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS datasets (
+            key INTEGER PRIMARY KEY,
+            content_provider TEXT,
+            created_date TEXT,
+            modified_date TEXT,
+            id TEXT,
+            doi TEXT,
+            url_api TEXT,
+            url_html TEXT,
+            title TEXT,
+            description TEXT,
+            keywords TEXT,
+            sum_size INTEGER,
+            files_types TEXT,
+            files TEXT,
+            files_http_status_code TEXT,
+            geospatial_flag INTEGER,
+            download_flag INTEGER,
+            processed_flag INTEGER,
+            timeout INTEGER,
+            bbox TEXT,
+            time_result_insert INTEGER,
+            metadata TEXT
+        )
+    """)
+
+
+def _migration_metadata_dictionaries(cursor: sqlite3.Cursor):
+    # shared dictionaries of helper_metadata_compression
+    create_dictionary_table(cursor)
+
+
+def _migration_archive_probe(cursor: sqlite3.Cursor):
+    # results of helper_archive_probe
+    add_column(cursor, "datasets", "archive_probe", "TEXT")
+
+
+def _migration_indexes(cursor: sqlite3.Cursor):
+    # threaded_dataset_analysis.main: datasets which are still to be analysed
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS datasets_analysis_queue
+        ON datasets (content_provider, sum_size)
+        WHERE download_flag = 1 AND processed_flag = 0
+    """)
+    # helper_quantile: sizes per content provider and flag (covering)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS datasets_provider_flags_size
+        ON datasets (content_provider, download_flag, geospatial_flag, processed_flag, sum_size)
+    """)
+    # helper_quantile, helper_geopackage, helper_convert_sqlite3_to_csv: results
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS datasets_processed
+        ON datasets (content_provider, sum_size)
+        WHERE processed_flag = 1
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS datasets_with_bbox
+        ON datasets (content_provider, sum_size)
+        WHERE bbox IS NOT NULL
+    """)
+    cursor.execute("ANALYZE")
+
+
+def _migration_dataset_files(cursor: sqlite3.Cursor):
+    # one row per file instead of the JSON text in datasets.files
+    create_dataset_files_table(cursor)
+
+    if cursor.execute("SELECT 1 FROM dataset_files LIMIT 1").fetchone() is None:
+        # fill from the raw metadata, which also contains size and checksum
+        codec = MetadataCodec.from_db(cursor.connection)
+        last_key = 0
+        while True:
+            rows = cursor.execute(
+                "SELECT key, content_provider, metadata FROM datasets WHERE key > ? ORDER BY key LIMIT 10000",
+                (last_key,),
+            ).fetchall()
+            if not rows:
+                break
+            last_key = rows[-1][0]
+
+            file_rows = []
+            for key, content_provider, metadata in rows:
+                files = get_files(content_provider, codec.decode(metadata))
+                file_rows.extend(get_dataset_file_rows(key, files))
+            cursor.executemany(INSERT_DATASET_FILE_QUERY, file_rows)
+
+    # numeric bbox columns, computed from the JSON text [minx, miny, maxx, maxy]
+    for index, column in enumerate(
+        ["bbox_minx", "bbox_miny", "bbox_maxx", "bbox_maxy"]
+    ):
+        add_column(
+            cursor,
+            "datasets",
+            column,
+            f"REAL GENERATED ALWAYS AS (json_extract(bbox, '$[{index}]')) VIRTUAL",
+        )
+
+
+def _migration_spatial_index(cursor: sqlite3.Cursor):
+    # R*Tree over the dataset bboxes, maintained by threaded_dataset_analysis.result_consumer
+    # (helper_spatial_index)
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS datasets_rtree
+        USING rtree (key, minx, maxx, miny, maxy)
+    """)
+    cursor.execute("""
+        INSERT OR REPLACE INTO datasets_rtree (key, minx, maxx, miny, maxy)
+        SELECT key, bbox_minx, bbox_maxx, bbox_miny, bbox_maxy
+        FROM datasets
+        WHERE bbox IS NOT NULL AND bbox_minx <= bbox_maxx AND bbox_miny <= bbox_maxy
+    """)
+
+
+def _migration_quantile_sketches(cursor: sqlite3.Cursor):
+    # KLL sketches of sum_size per content provider and flag (helper_quantile_sketch)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS quantile_sketches (
+            content_provider TEXT,
+            flag TEXT,
+            sketch TEXT,
+            max_key INTEGER,
+            PRIMARY KEY (content_provider, flag)
+        )
+    """)
+
+
+def _statistics_delta(row: str, sign: str) -> str:
+    # adds (sign "+") or removes (sign "-") the contribution of a datasets row
+    return f"""
+        INSERT OR IGNORE INTO statistics_dataset_analysis
+        (content_provider, processed_counter, processed_data_volume, timeout_counter, with_bbox)
+        VALUES ({row}.content_provider, 0, 0, 0, 0);
+        UPDATE statistics_dataset_analysis
+        SET processed_counter = processed_counter {sign} ({row}.processed_flag = 1),
+            processed_data_volume = processed_data_volume {sign} (
+                CASE WHEN {row}.processed_flag = 1 THEN COALESCE({row}.sum_size, 0) ELSE 0 END
+            ),
+            timeout_counter = timeout_counter {sign} (
+                {row}.processed_flag = 1 AND COALESCE({row}.timeout, 0) != 0
+            ),
+            with_bbox = with_bbox {sign} ({row}.processed_flag = 1 AND {row}.bbox IS NOT NULL)
+        WHERE content_provider = {row}.content_provider;
+    """
+
+
+def _migration_statistics_triggers(cursor: sqlite3.Cursor):
+    # statistics_dataset_analysis is maintained by triggers in the same transaction as
+    # the datasets rows (one row per content provider)
+    cursor.execute("""
+        DELETE FROM statistics_dataset_analysis
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM statistics_dataset_analysis GROUP BY content_provider
+        )
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS statistics_dataset_analysis_provider
+        ON statistics_dataset_analysis (content_provider)
+    """)
+
+    # recompute from the datasets table, the counters may have drifted after a crash
+    cursor.execute("""
+        INSERT OR IGNORE INTO statistics_dataset_analysis
+        (content_provider, processed_counter, processed_data_volume, timeout_counter, with_bbox)
+        SELECT DISTINCT content_provider, 0, 0, 0, 0 FROM datasets
+    """)
+    cursor.execute("""
+        UPDATE statistics_dataset_analysis
+        SET processed_counter = COALESCE(totals.processed_counter, 0),
+            processed_data_volume = COALESCE(totals.processed_data_volume, 0),
+            timeout_counter = COALESCE(totals.timeout_counter, 0),
+            with_bbox = COALESCE(totals.with_bbox, 0)
+        FROM (
+            SELECT provider.content_provider,
+                COUNT(datasets.key) AS processed_counter,
+                SUM(COALESCE(datasets.sum_size, 0)) AS processed_data_volume,
+                SUM(COALESCE(datasets.timeout, 0) != 0) AS timeout_counter,
+                SUM(datasets.bbox IS NOT NULL) AS with_bbox
+            FROM statistics_dataset_analysis AS provider
+            LEFT JOIN datasets
+            ON datasets.content_provider = provider.content_provider
+            AND datasets.processed_flag = 1
+            GROUP BY provider.content_provider
+        ) AS totals
+        WHERE statistics_dataset_analysis.content_provider = totals.content_provider
+    """)
+
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS datasets_statistics_insert
+        AFTER INSERT ON datasets
+        BEGIN
+            {_statistics_delta("NEW", "+")}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS datasets_statistics_update
+        AFTER UPDATE OF content_provider, processed_flag, sum_size, timeout, bbox
+        ON datasets
+        WHEN OLD.processed_flag = 1 OR NEW.processed_flag = 1
+        BEGIN
+            {_statistics_delta("OLD", "-")}
+            {_statistics_delta("NEW", "+")}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS datasets_statistics_delete
+        AFTER DELETE ON datasets
+        BEGIN
+            {_statistics_delta("OLD", "-")}
+        END
+    """)
+
+
+def _migration_file_extents(cursor: sqlite3.Cursor):
+    # geoextent results per file (or directory) for re-runs (helper_file_extents)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS file_extents (
+            file_hash TEXT,
+            size INTEGER,
+            geoextent_version TEXT,
+            options TEXT,
+            bbox TEXT,
+            format TEXT,
+            processing_time REAL,
+            time_insert INTEGER,
+            PRIMARY KEY (file_hash, size, geoextent_version, options)
+        )
+    """)
+
+
+def _migration_geoextent_timings(cursor: sqlite3.Cursor):
+    # processing times (and timeouts) of geoextent for the timeout model
+    # (helper_timeout_model)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS geoextent_timings (
+            id INTEGER PRIMARY KEY,
+            extension TEXT,
+            size INTEGER,
+            mode TEXT,
+            processing_time REAL,
+            timeout REAL,
+            timed_out INTEGER,
+            geoextent_version TEXT,
+            time_insert INTEGER
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS geoextent_timings_extension
+        ON geoextent_timings (extension)
+    """)
+
+
+def _migration_quantile_sketch_triggers(cursor: sqlite3.Cursor):
+    # KLL sketches cannot remove values: a changed datasets row (e.g. the archive probe
+    # clearing download_flag) drops the sketches of its content provider, which
+    # helper_quantile_sketch.update_sketches rebuilds from key 0
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS datasets_quantile_sketches_insert
+        AFTER INSERT ON datasets
+        WHEN NEW.key <= (
+            SELECT MAX(max_key) FROM quantile_sketches
+            WHERE content_provider = NEW.content_provider
+        )
+        BEGIN
+            DELETE FROM quantile_sketches WHERE content_provider = NEW.content_provider;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS datasets_quantile_sketches_update
+        AFTER UPDATE OF content_provider, sum_size, download_flag, geospatial_flag
+        ON datasets
+        WHEN OLD.content_provider IS NOT NEW.content_provider
+            OR OLD.sum_size IS NOT NEW.sum_size
+            OR OLD.download_flag IS NOT NEW.download_flag
+            OR OLD.geospatial_flag IS NOT NEW.geospatial_flag
+        BEGIN
+            DELETE FROM quantile_sketches
+            WHERE content_provider IN (OLD.content_provider, NEW.content_provider);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS datasets_quantile_sketches_delete
+        AFTER DELETE ON datasets
+        BEGIN
+            DELETE FROM quantile_sketches WHERE content_provider = OLD.content_provider;
+        END
+    """)
+
+
+SCHEMA_MIGRATIONS = [
+    _migration_base_tables,
+    _migration_metadata_dictionaries,
+    _migration_archive_probe,
+    _migration_indexes,
+    _migration_dataset_files,
+    _migration_spatial_index,
+    _migration_quantile_sketches,
+    _migration_statistics_triggers,
+    _migration_file_extents,
+    _migration_geoextent_timings,
+    _migration_quantile_sketch_triggers,
+]
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+# first schema versions with the bbox_* columns and with datasets_rtree
+BBOX_COLUMNS_VERSION = SCHEMA_MIGRATIONS.index(_migration_dataset_files) + 1
+SPATIAL_INDEX_VERSION = SCHEMA_MIGRATIONS.index(_migration_spatial_index) + 1
+
+
+INSERT_DATASET_FILE_QUERY = """
+    INSERT INTO dataset_files (dataset_key, name, url, size, extension, checksum)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def create_dataset_files_table(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dataset_files (
+            id INTEGER PRIMARY KEY,
+            dataset_key INTEGER NOT NULL REFERENCES datasets (key),
+            name TEXT,
+            url TEXT,
+            size INTEGER,
+            extension TEXT,
+            checksum TEXT
+        )
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS dataset_files_dataset_key ON dataset_files (dataset_key)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS dataset_files_extension_size ON dataset_files (extension, size)"
+    )
+
+
+def get_dataset_file_rows(key: int, files: list) -> list:
+    """
+    Returns the rows of dataset_files for the files (helper_metadata_downloader.get_files)
+    of a dataset.
+    """
+    return [
+        (
+            key,
+            file["name"],
+            file["url"],
+            file["size"],
+            file["extension"],
+            file["checksum"],
+        )
+        for file in files
+    ]
+
+
+def add_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str):
+    # table_xinfo also lists generated columns
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_xinfo({table})")]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def check_schema_version(conn: sqlite3.Connection, required_version: int):
+    """
+    Raises a RuntimeError if the database is older than required_version. Readers call
+    this instead of migrate, which would rewrite the database (e.g. the archived
+    FINAL_metadata_db) as a side effect of an export.
+    """
+    version = get_schema_version(conn)
+    if version < required_version:
+        raise RuntimeError(
+            f"Database schema version {version} is older than required ({required_version}), "
+            + "migrate it first: python3 helper_sqlite_schema.py"
+        )
+
+
+def migrate(conn: sqlite3.Connection, target_version: int = SCHEMA_VERSION) -> int:
+    """
+    Applies all missing migrations up to target_version in place and returns the
+    schema version. Each migration runs in its own transaction.
+    """
+    version = get_schema_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version {version} is newer than supported ({SCHEMA_VERSION})."
+        )
+
+    if conn.in_transaction:
+        conn.commit()
+
+    for next_version in range(version + 1, target_version + 1):
+        time_begin = time.time()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            SCHEMA_MIGRATIONS[next_version - 1](cursor)
+            cursor.execute(f"PRAGMA user_version = {next_version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        if time.time() - time_begin > 1:
+            print(
+                f"Migrated database to schema version {next_version} "
+                + f"({SCHEMA_MIGRATIONS[next_version - 1].__name__}) "
+                + f"in {time.time() - time_begin:.1f} s."
+            )
+
+    return get_schema_version(conn)
+
+
+def migrate_database(sqlite_path: str) -> int:
+    if not Path(sqlite_path).is_file():
+        print(f"Database {sqlite_path} does not exist.")
+        return
+
+    conn = sqlite3.connect(sqlite_path)
+    version = migrate(conn)
+    conn.close()
+
+    print(f"Database {Path(sqlite_path).name} has schema version {version}.")
+
+    return version
+
+
+if __name__ == "__main__":
+    sqlite_path = "/home/lars/FINAL_metadata_db.sqlite3"
+
+    migrate_database(sqlite_path)
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+
+class DiskBudget:
+    """
+    Admission control for downloads into a temp drive: the expected size of a dataset
+    is reserved before its download starts and released when its temp directory is
+    cleaned up, so that the reserved bytes never exceed the budget.
+
+    budget_bytes: if None, the free space of the drive minus safety_margin_bytes
+    """
+
+    def __init__(
+        self,
+        path: str,
+        budget_bytes: int | None = None,
+        safety_margin_bytes: int = 2 * 1024**3,
+    ):
+        self.path = path
+        Path(path).mkdir(parents=True, exist_ok=True)
+
+        free_bytes = max(0, shutil.disk_usage(path).free - safety_margin_bytes)
+        self.budget = (
+            free_bytes if budget_bytes is None else min(budget_bytes, free_bytes)
+        )
+        self.reserved = 0
+        self._condition = threading.Condition()
+
+    def fits(self, size: int) -> bool:
+        return size <= self.budget
+
+    def reserve(
+        self,
+        size: int,
+        stop_event: threading.Event | None = None,
+        blocking: bool = True,
+    ) -> bool:
+        """
+        Blocks until size bytes can be reserved. Returns False if stop_event is set while
+        waiting or, if not blocking, the bytes are not available now (nothing is
+        reserved).
+        """
+        if not self.fits(size):
+            raise ValueError(f"{size} B exceed the disk budget of {self.budget} B.")
+
+        with self._condition:
+            while self.reserved + size > self.budget:
+                if not blocking or (stop_event is not None and stop_event.is_set()):
+                    return False
+                self._condition.wait(timeout=1)
+            self.reserved += size
+
+        return True
+
+    def release(self, size: int):
+        with self._condition:
+            self.reserved = max(0, self.reserved - size)
+            self._condition.notify_all()
+
+    def temporary_directory(
+        self,
+        size: int,
+        stop_event: threading.Event | None = None,
+        name: str | None = None,
+        blocking: bool = True,
+    ) -> "BudgetedDirectory | None":
+        """
+        Returns a directory in path with size bytes reserved, which are released by its
+        cleanup() or release(), or None if stop_event is set while waiting (or the
+        bytes are not available now if not blocking).
+
+        name: deterministic directory (e.g. to continue downloads of an earlier run),
+              otherwise a new temp directory
+        """
+        if not self.reserve(size, stop_event, blocking):
+            return None
+        try:
+            if name is None:
+                directory = tempfile.mkdtemp(dir=self.path)
+            else:
+                directory = Path(self.path).joinpath(name)
+                directory.mkdir(parents=True, exist_ok=True)
+            return BudgetedDirectory(self, size, str(directory))
+        except Exception:
+            self.release(size)
+            raise
+
+    def status_text(self) -> str:
+        return f"{self.reserved / 1024**3:.1f}/{self.budget / 1024**3:.1f} GiB"
+
+
+class TieredStaging:
+    """
+    Staging in two tiers: datasets up to threshold_bytes go to a RAM-backed directory
+    (tmpfs, e.g. /dev/shm) with its own budget, larger datasets and small ones which do
+    not fit into the memory budget right now go to the disk.
+
+    Has the interface of DiskBudget used by the download workers.
+    """
+
+    def __init__(
+        self,
+        disk_budget: DiskBudget,
+        memory_budget: DiskBudget | None = None,
+        threshold_bytes: int = 64 * 1024**2,
+    ):
+        self.disk_budget = disk_budget
+        self.memory_budget = memory_budget
+        self.threshold_bytes = threshold_bytes
+
+    def _is_small(self, size: int) -> bool:
+        return (
+            self.memory_budget is not None
+            and size <= self.threshold_bytes
+            and self.memory_budget.fits(size)
+        )
+
+    def fits(self, size: int) -> bool:
+        return self._is_small(size) or self.disk_budget.fits(size)
+
+    def temporary_directory(
+        self,
+        size: int,
+        stop_event: threading.Event | None = None,
+        name: str | None = None,
+    ) -> "BudgetedDirectory | None":
+        # partial downloads of an earlier run are continued on the disk
+        on_disk = name is not None and Path(self.disk_budget.path, name).is_dir()
+
+        if self._is_small(size) and not on_disk:
+            tmp_dir = self.memory_budget.temporary_directory(
+                size, stop_event, name, blocking=not self.disk_budget.fits(size)
+            )
+            if tmp_dir is not None or not self.disk_budget.fits(size):
+                return tmp_dir
+
+        return self.disk_budget.temporary_directory(size, stop_event, name)
+
+    def status_text(self) -> str:
+        if self.memory_budget is None:
+            return self.disk_budget.status_text()
+        return (
+            f"{self.disk_budget.status_text()}, RAM {self.memory_budget.status_text()}"
+        )
+
+
+class BudgetedDirectory:
+    def __init__(self, disk_budget: DiskBudget, size: int, name: str):
+        self.disk_budget = disk_budget
+        self.size = size
+        self.name = name
+        self._release_lock = threading.Lock()
+        self._released = False
+
+    def grow(self, size: int) -> bool:
+        """
+        Reserves size more bytes (e.g. for extracted archives) if they are available now,
+        they are released with the directory. Returns False otherwise.
+        """
+        if not self.disk_budget.fits(size):
+            return False
+        if not self.disk_budget.reserve(size, blocking=False):
+            return False
+        with self._release_lock:
+            if self._released:
+                self.disk_budget.release(size)
+                return False
+            self.size += size
+        return True
+
+    def cleanup(self):
+        try:
+            shutil.rmtree(self.name, ignore_errors=True)
+        finally:
+            self.release()
+
+    def release(self):
+        # keeps the files, e.g. partial downloads for a later run
+        with self._release_lock:
+            if not self._released:
+                self._released = True
+                self.disk_budget.release(self.size)
@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+
+import shutil
+import struct
+import tarfile
+import zlib
+from pathlib import Path, PurePosixPath
+
+from helper_metadata_downloader import SUPPORTED_ARCHIVE_FORMATS
+from helper_metadata_downloader import SUPPORTED_GEOSPATIAL_FORMATS
+
+# files which belong to a shapefile (.shp)
+SHAPEFILE_SIDECAR_FORMATS = [".shx", ".dbf", ".prj", ".cpg", ".sbn", ".sbx", ".qix"]
+
+STREAMING_FORMATS = {
+    ".zip": "zip",
+    ".tar": "tar",
+    ".tar.gz": "tar",
+    ".tgz": "tar",
+    ".tar.bz2": "tar",
+    ".tbz2": "tar",
+    ".tar.xz": "tar",
+    ".txz": "tar",
+}
+
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+LOCAL_FILE_HEADER_SIGNATURE = b"PK\x03\x04"
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+EOCD_SIGNATURE = b"PK\x05\x06"
+LOCAL_FILE_HEADER = struct.Struct("<4s5H3I2H")  # 30 bytes + name, extra
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class StreamingNotSupported(Exception):
+    """Exception raised if an archive cannot be extracted while it is downloaded."""
+
+    pass
+
+
+class _ByteStream:
+    """
+    File-like object over an iterator of byte chunks (e.g. response.iter_content).
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_exactly(self, size: int) -> bytes:
+        data = self.read(size)
+        if len(data) < size:
+            raise EOFError("Unexpected end of stream.")
+        return data
+
+    def read_chunk(self) -> bytes:
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            return data
+        return next(self._chunks, b"")
+
+    def unread(self, data: bytes):
+        self._buffer[:0] = data
+
+
+class _ReservedFile:
+    """
+    File opened for writing, whose bytes are reserved before they are written
+    (e.g. BudgetedDirectory.grow): size at open (if known), more while writing.
+    """
+
+    def __init__(self, path: Path, size: int | None, reserve):
+        self._reserve = reserve
+        self._reserved = 0
+        self._written = 0
+        if size:
+            self._grow(size)
+        self._file = open(path, "wb")
+
+    def _grow(self, size: int):
+        if self._reserve is not None and not self._reserve(size):
+            raise StreamingNotSupported(f"{size} B more do not fit into the budget")
+        self._reserved += size
+
+    def write(self, data: bytes):
+        if self._written + len(data) > self._reserved:
+            self._grow(max(self._written + len(data) - self._reserved, CHUNK_SIZE))
+        self._written += len(data)
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_wanted(name: str) -> bool:
+    """
+    True for geospatial files, shapefile sidecars and nested archives.
+    """
+    extension = PurePosixPath(name).suffix.lower()
+    return (
+        extension in SUPPORTED_GEOSPATIAL_FORMATS
+        or extension in SHAPEFILE_SIDECAR_FORMATS
+        or extension in SUPPORTED_ARCHIVE_FORMATS
+    )
+
+
+def get_streaming_format(filename: str) -> str | None:
+    name = filename.lower()
+    for extension in sorted(STREAMING_FORMATS, key=len, reverse=True):
+        if name.endswith(extension):
+            return STREAMING_FORMATS[extension]
+    return None
+
+
+def _target_path(directory: Path, name: str) -> Path | None:
+    # no absolute paths or ".." outside of the target directory
+    parts = [
+        part for part in PurePosixPath(name.replace("\\", "/")).parts if part != "/"
+    ]
+    if not parts or ".." in parts:
+        return None
+    return directory.joinpath(*parts)
+
+
+def _inflate(stream: _ByteStream, dst):
+    # raw deflate stream of unknown length, the rest is pushed back to the stream
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while not decompressor.eof:
+        chunk = stream.read_chunk()
+        if not chunk:
+            raise EOFError("Unexpected end of deflate stream.")
+        data = decompressor.decompress(chunk)
+        if dst is not None:
+            dst.write(data)
+    stream.unread(decompressor.unused_data)
+
+
+def _copy(stream: _ByteStream, size: int, method: int, dst):
+    if method == 8:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while size > 0:
+        chunk = stream.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("Unexpected end of stream.")
+        size -= len(chunk)
+        if dst is not None:
+            dst.write(decompressor.decompress(chunk) if method == 8 else chunk)
+    if dst is not None and method == 8:
+        dst.write(decompressor.flush())
+
+
+def _extract_zip(stream: _ByteStream, directory: Path, reserve=None) -> list:
+    extracted = []
+    header = stream.read(4)
+    if header not in (LOCAL_FILE_HEADER_SIGNATURE, EOCD_SIGNATURE):
+        raise StreamingNotSupported("not a zip file")
+    stream.unread(header)
+
+    while True:
+        header = stream.read(LOCAL_FILE_HEADER.size)
+        if len(header) < 4 or header[:4] != LOCAL_FILE_HEADER_SIGNATURE:
+            # central directory (or end of stream): all members are read
+            break
+        if len(header) < LOCAL_FILE_HEADER.size:
+            raise EOFError("Unexpected end of stream.")
+
+        (
+            _,
+            _,
+            flags,
+            method,
+            _,
+            _,
+            _,
+            compressed_size,
+            uncompressed_size,
+            name_length,
+            extra_length,
+        ) = LOCAL_FILE_HEADER.unpack(header)
+        name = stream.read_exactly(name_length)
+        extra = stream.read_exactly(extra_length)
+        name = name.decode("utf-8" if flags & 0x800 else "cp437", "replace")
+
+        if flags & 0x1:
+            raise StreamingNotSupported("encrypted member")
+        if method not in (0, 8):
+            raise StreamingNotSupported(f"compression method {method}")
+
+        # zip64: sizes in the extra field
+        zip64 = False
+        position = 0
+        while position + 4 <= len(extra):
+            header_id, size = struct.unpack_from("<2H", extra, position)
+            if header_id == 0x0001:
+                zip64 = True
+                if size >= 16:
+                    uncompressed_size, zip64_compressed_size = struct.unpack_from(
+                        "<2Q", extra, position + 4
+                    )
+                    if compressed_size == 0xFFFFFFFF:
+                        compressed_size = zip64_compressed_size
+            position += 4 + size
+
+        target = None if name.endswith("/") or not is_wanted(name) else name
+        target = _target_path(directory, target) if target else None
+        if target is not None:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # the sizes are 0 if they follow in a data descriptor, then the bytes are
+            # reserved while writing
+            dst = _ReservedFile(target, uncompressed_size, reserve)
+        else:
+            dst = None
+
+        try:
+            if flags & 0x8:
+                # sizes follow the data in a data descriptor
+                if method != 8:
+                    raise StreamingNotSupported("stored member with data descriptor")
+                _inflate(stream, dst)
+                signature = stream.read_exactly(4)
+                if signature != DATA_DESCRIPTOR_SIGNATURE:
+                    stream.unread(signature)
+                stream.read_exactly(4 + (16 if zip64 else 8))
+            else:
+                _copy(stream, compressed_size, method, dst)
+        finally:
+            if dst is not None:
+                dst.close()
+
+        if target is not None:
+            extracted.append(target)
+
+    return extracted
+
+
+def _extract_tar(stream: _ByteStream, directory: Path, reserve=None) -> list:
+    extracted = []
+    try:
+        with tarfile.open(fileobj=stream, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile() or not is_wanted(member.name):
+                    continue
+                target = _target_path(directory, member.name)
+                if target is None:
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with (
+                    tar.extractfile(member) as src,
+                    _ReservedFile(target, member.size, reserve) as dst,
+                ):
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                extracted.append(target)
+    except tarfile.ReadError as e:
+        raise StreamingNotSupported(str(e))
+
+    return extracted
+
+
+def stream_extract(chunks, filename: str, directory: str, reserve=None) -> list:
+    """
+    Extracts only the geospatial members (with shapefile sidecars) and nested archives
+    of a zip or tar archive while it is downloaded, e.g.
+    stream_extract(resp.iter_content(chunk_size=CHUNK_SIZE), "dataset.zip", tmp_dir.name).
+    Other members never touch the disk. Returns the paths of the extracted files.
+
+    reserve: reserves the uncompressed bytes of a member before they are written and
+             returns False if they do not fit, e.g. tmp_dir.grow (helper_staging)
+
+    Raises StreamingNotSupported if the archive has to be downloaded completely.
+    """
+    directory = Path(directory).joinpath(f"{filename}.extracted")
+    directory.mkdir(parents=True, exist_ok=True)
+    stream = _ByteStream(chunks)
+
+    try:
+        match get_streaming_format(filename):
+            case "zip":
+                return _extract_zip(stream, directory, reserve)
+            case "tar":
+                return _extract_tar(stream, directory, reserve)
+            case _:
+                raise StreamingNotSupported(filename)
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+import math
+import sqlite3
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+from geoextent.__init__ import __version__ as geoextent_version
+
+from helper_metadata_downloader import SUPPORTED_ARCHIVE_FORMATS
+from helper_metadata_downloader import SUPPORTED_GEOSPATIAL_FORMATS
+
+INSERT_TIMING_QUERY = """
+    INSERT INTO geoextent_timings
+    (extension, size, mode, processing_time, timeout, timed_out, geoextent_version, time_insert)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def get_profile(path: str) -> tuple[str, int]:
+    """
+    Returns the extension and size of a file, or the extension with the most bytes
+    (geospatial and archive formats first) and the size of all files in a directory.
+    """
+    path = Path(path)
+    if path.is_file():
+        return path.suffix.lower(), path.stat().st_size
+
+    sizes = defaultdict(int)
+    for file in path.rglob("*"):
+        if file.is_file():
+            sizes[file.suffix.lower()] += file.stat().st_size
+    if not sizes:
+        return "", 0
+
+    supported = SUPPORTED_GEOSPATIAL_FORMATS + SUPPORTED_ARCHIVE_FORMATS
+    extension = max(
+        sizes, key=lambda extension: (extension in supported, sizes[extension])
+    )
+    return extension, sum(sizes.values())
+
+
+def get_timing_row(
+    path: str, mode: str, processing_time: float, timeout: int, timed_out: bool
+) -> tuple:
+    extension, size = get_profile(path)
+    return (
+        extension,
+        size,
+        mode,
+        processing_time,
+        timeout,
+        int(timed_out),
+        geoextent_version,
+        int(time.time()),
+    )
+
+
+class TimeoutModel:
+    """
+    Predicts the geoextent timeout of a file or directory from the processing times of
+    earlier runs (geoextent_timings) with the same extension: log(time) is fitted
+    linearly to log(size), per extension or over all extensions with fewer than
+    min_samples. The timeout is the upper prediction (z standard deviations of the
+    residuals) times safety_factor, between min_timeout and max_timeout (the cap).
+
+    Runs which timed out are not fitted, their processing time is only a lower bound:
+    an input (same extension and size) which timed out gets at least safety_factor times
+    its longest timed-out run, so its timeout grows until it finishes or hits the cap.
+    """
+
+    def __init__(
+        self,
+        cursor: sqlite3.Cursor,
+        max_timeout: int = 30 * 60,
+        min_timeout: int = 60,
+        z: float = 2.0,
+        safety_factor: float = 2.0,
+        min_samples: int = 10,
+    ):
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.z = z
+        self.safety_factor = safety_factor
+        self.min_samples = min_samples
+
+        cursor.execute("""
+            SELECT extension, size, processing_time FROM geoextent_timings
+            WHERE size > 0 AND processing_time > 0 AND timed_out = 0
+        """)
+        samples = defaultdict(list)
+        for extension, size, processing_time in cursor.fetchall():
+            samples[extension].append((math.log(size), math.log(processing_time)))
+            samples[None].append((math.log(size), math.log(processing_time)))
+
+        self.fits = {}
+        for extension, values in samples.items():
+            if len(values) >= min_samples:
+                self.fits[extension] = self._fit(values)
+
+        cursor.execute("""
+            SELECT extension, size, MAX(processing_time) FROM geoextent_timings
+            WHERE timed_out = 1
+            GROUP BY extension, size
+        """)
+        self.lower_bounds = {
+            (extension, size): processing_time
+            for extension, size, processing_time in cursor.fetchall()
+        }
+
+    @staticmethod
+    def _fit(values: list) -> tuple[float, float, float]:
+        log_sizes, log_times = (np.array(column) for column in zip(*values))
+        if np.ptp(log_sizes) > 0:
+            slope, intercept = np.polyfit(log_sizes, log_times, 1)
+        else:
+            slope, intercept = 0.0, float(np.mean(log_times))
+        residuals = log_times - (slope * log_sizes + intercept)
+        return float(slope), float(intercept), float(np.std(residuals))
+
+    def predict(self, extension: str, size: int) -> float | None:
+        """
+        Returns the upper prediction of the processing time [s], or None without data.
+        """
+        fit = self.fits.get(extension, self.fits.get(None))
+        if fit is None:
+            return None
+        slope, intercept, sigma = fit
+        return math.exp(slope * math.log(max(size, 1)) + intercept + self.z * sigma)
+
+    def get_timeout(self, path: str) -> int:
+        extension, size = get_profile(path)
+        prediction = self.predict(extension, size)
+        if prediction is None:
+            return self.max_timeout
+        prediction = max(prediction, self.lower_bounds.get((extension, size), 0))
+        return int(
+            min(
+                self.max_timeout,
+                max(self.min_timeout, math.ceil(prediction * self.safety_factor)),
+            )
+        )
@@ -1,27 +1,72 @@
 #!/usr/bin/python3
 
+import itertools
 import json
 import logging
 import math
-import multiprocessing
 import queue
 import sqlite3
-import tempfile
 import threading
 import time
 import urllib.parse
 from pathlib import Path
-from requests import Session, HTTPError
+from requests import Session, HTTPError, RequestException
 
-import geoextent.lib.extent as geoextent
 import geoextent.lib.extent as geoextent_help  # noqa: F401
 from geoextent.__init__ import __version__ as geoextent_version  # noqa: F401
 
+from helper_archive_probe import is_skippable
+from helper_download_cache import DownloadCache
+from helper_file_extents import ExtentMemo
+from helper_file_extents import INSERT_FILE_EXTENT_QUERY
+from helper_geoextent_pool import GeoextentPool
+from helper_geoextent_pool import PoolAutoscaler
+from helper_geoextent_pool import get_cpu_count
+from helper_geoextent_pool import merge_bboxes
+from helper_geoextent_pool import run_per_file
+from helper_quantile_sketch import get_quantile
+from helper_quantile_sketch import update_sketches
+from helper_remote_geotiff import REMOTE_GEOTIFF_FORMATS
+from helper_remote_geotiff import probe_remote_geotiff
+from helper_resumable_download import cleanup_orphans
+from helper_resumable_download import discard_partial
+from helper_resumable_download import finish_download
+from helper_resumable_download import get_resume_headers
+from helper_resumable_download import get_staging_name
+from helper_resumable_download import has_partial
+from helper_resumable_download import is_complete
+from helper_resumable_download import tee_response
+from helper_resumable_download import validate_file
+from helper_resumable_download import write_response
+from helper_scheduler import PriorityTaskQueue
+from helper_scheduler import get_priority
+from helper_scheduler import get_success_rates
+from helper_spatial_index import update_spatial_index_many
+from helper_sqlite_schema import migrate
+from helper_staging import DiskBudget
+from helper_staging import TieredStaging
+from helper_streaming_extract import StreamingNotSupported
+from helper_streaming_extract import get_streaming_format
+from helper_streaming_extract import stream_extract
+from helper_timeout_model import INSERT_TIMING_QUERY
+from helper_timeout_model import TimeoutModel
+
 
 logging.basicConfig(level=logging.CRITICAL)
 logging.getLogger("geoextent").setLevel(logging.CRITICAL)
 
 
+# guards the counters in worker_statistics, which are shared by all worker threads
+worker_statistics_lock = threading.Lock()
+
+# guards provider_sleep_info ([reset_time, next_request_time] per content provider),
+# which is shared by all download workers of a content provider
+provider_sleep_lock = threading.Lock()
+
+# [s] between two requests to a content provider (all of its download workers)
+REQUEST_INTERVAL = 1
+
+
 class StopThreadException(Exception):
     """Exception raised if a thread needs to be terminated due to a stop event."""
 
@@ -36,173 +81,339 @@ def download_worker(
     worker_statistics: dict,
     content_provider: str,
     provider_sleep_info: dict,
+    disk_budget: DiskBudget | TieredStaging,
+    download_cache: DownloadCache | None = None,
 ):
-    while not stop_event.is_set():
-        try:
-            key, doi, files, sum_size = task_queue.get(timeout=1.0)
-        except queue.Empty:
-            continue
-
-        with threading.Lock():
-            worker_statistics["active_download_worker"][0] += 1
-
-        session = Session()
-        temp_parent = "/run/media/lars/8f0c1f09-2c90-4cb3-ac63-19295ea5ede3/tmp"
-        Path(temp_parent).mkdir(parents=True, exist_ok=True)
-
-        # print("DEBUG:", key, files, sum_size)
-
-        dryad_sum_size_threshold_byte = 200000000
-        # threshold determined by testing
-        # SELECT key, doi, sum_size FROM datasets WHERE content_provider = "dryad" and sum_size < 209715200 ORDER BY sum_size DESC
-        # no    208446870	doi:10.5061/dryad.kd51c5bcr https://datadryad.org/api/v2/datasets/doi%3A10.5061%2Fdryad.kd51c5bcr/download
-        # no    200067489	doi:10.5061/dryad.83bk3j9s2 https://datadryad.org/api/v2/datasets/doi%3A10.5061%2Fdryad.83bk3j9s2/download
-        # works 199666406	doi:10.5061/dryad.c3770vq   https://datadryad.org/api/v2/datasets/doi%3A10.5061%2Fdryad.c3770vq/download
-
-        # https://docs.python.org/3/library/tempfile.html#tempfile.TemporaryDirectory
-        tmp_dir = tempfile.TemporaryDirectory(dir=temp_parent)
-
-        # dryad: try to download single zip file
-        if content_provider == "dryad" and sum_size < dryad_sum_size_threshold_byte:
-            try:
-                filename = "dataset.zip"
-                file_link = (
-                    "https://datadryad.org/api/v2/datasets/"
-                    + urllib.parse.quote(doi, safe="")
-                    + "/download"
-                )
-                resp = _request(
-                    stop_event,
-                    content_provider,
-                    provider_sleep_info,
-                    session,
-                    file_link,
-                    throttle=True,
-                    stream=True,
-                )
-                filepath = Path(tmp_dir.name).joinpath(filename)
-                # TODO: catch http error (?)
-                with open(filepath, "wb") as dst:
-                    for chunk in resp.iter_content(chunk_size=None):
-                        dst.write(chunk)
-
-                files_http_status = resp.status_code
-                geoextent_queue.put(
-                    [content_provider, key, sum_size, files_http_status, tmp_dir]
-                )
-
-                with threading.Lock():
-                    worker_statistics["active_download_worker"][0] -= 1
-                time.sleep(1)
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None or stop_event.is_set():
+                # sentinel: no more datasets of the content provider
+                break
+            key, doi, files, sum_size, archive_probe = task
+
+            if not disk_budget.fits(sum_size):
+                print(f"INFO: {key} skipped, {sum_size} B exceed the disk budget.")
                 continue
 
-            except ValueError as e:
-                print("DEBUG: ValueError download:", e)
-                metadata = {}
-                files_http_status = "undefined"
-                result_queue.put(
-                    [content_provider, key, sum_size, files_http_status, metadata]
-                )
+            # wait until the dataset fits into the disk budget of the temp drive
+            # staging directory of the dataset, partial downloads are kept after a stop
+            tmp_dir = disk_budget.temporary_directory(
+                sum_size, stop_event, get_staging_name(key)
+            )
+            if tmp_dir is None:
+                break
+
+            with worker_statistics_lock:
+                worker_statistics["active_download_worker"][0] += 1
+
+            session = Session()
+
+            # print("DEBUG:", key, files, sum_size)
+
+            dryad_sum_size_threshold_byte = 200000000
+            # threshold determined by testing
+            # SELECT key, doi, sum_size FROM datasets WHERE content_provider = "dryad" and sum_size < 209715200 ORDER BY sum_size DESC
+            # no    208446870	doi:10.5061/dryad.kd51c5bcr https://datadryad.org/api/v2/datasets/doi%3A10.5061%2Fdryad.kd51c5bcr/download
+            # no    200067489	doi:10.5061/dryad.83bk3j9s2 https://datadryad.org/api/v2/datasets/doi%3A10.5061%2Fdryad.83bk3j9s2/download
+            # works 199666406	doi:10.5061/dryad.c3770vq   https://datadryad.org/api/v2/datasets/doi%3A10.5061%2Fdryad.c3770vq/download
+
+            # dryad: try to download single zip file
+            if content_provider == "dryad" and sum_size < dryad_sum_size_threshold_byte:
+                try:
+                    filename = "dataset.zip"
+                    file_link = (
+                        "https://datadryad.org/api/v2/datasets/"
+                        + urllib.parse.quote(doi, safe="")
+                        + "/download"
+                    )
+                    files_http_status = _download(
+                        stop_event,
+                        content_provider,
+                        provider_sleep_info,
+                        session,
+                        file_link,
+                        filename,
+                        tmp_dir.name,
+                    )
 
-                tmp_dir.cleanup()
-                with threading.Lock():
-                    worker_statistics["active_download_worker"][0] -= 1
-                time.sleep(1)
-                continue
+                    geoextent_queue.put(
+                        [
+                            content_provider,
+                            key,
+                            sum_size,
+                            files_http_status,
+                            tmp_dir,
+                            [],
+                        ]
+                    )
 
-            except HTTPError as e:
-                if (
-                    e.response.content
-                    != b"The dataset is too large for zip file generation. Please download each file individually."
-                ):
-                    print("DEBUG: HTTPError download:", e)
+                    with worker_statistics_lock:
+                        worker_statistics["active_download_worker"][0] -= 1
+                    continue
+
+                except ValueError as e:
+                    print("DEBUG: ValueError download:", e)
                     metadata = {}
-                    files_http_status = e.response.status_code
+                    files_http_status = "undefined"
                     result_queue.put(
                         [content_provider, key, sum_size, files_http_status, metadata]
                     )
 
                     tmp_dir.cleanup()
-                    with threading.Lock():
+                    with worker_statistics_lock:
                         worker_statistics["active_download_worker"][0] -= 1
-                    time.sleep(1)
                     continue
-                else:
-                    print(
-                        "INFO: 'Dryad: The dataset is too large for zip file generation. Please download each file individually.'"
+
+                except HTTPError as e:
+                    if (
+                        e.response.content
+                        != b"The dataset is too large for zip file generation. Please download each file individually."
+                    ):
+                        print("DEBUG: HTTPError download:", e)
+                        metadata = {}
+                        files_http_status = e.response.status_code
+                        result_queue.put(
+                            [
+                                content_provider,
+                                key,
+                                sum_size,
+                                files_http_status,
+                                metadata,
+                            ]
+                        )
+
+                        tmp_dir.cleanup()
+                        with worker_statistics_lock:
+                            worker_statistics["active_download_worker"][0] -= 1
+                        continue
+                    else:
+                        print(
+                            "INFO: 'Dryad: The dataset is too large for zip file generation. Please download each file individually.'"
+                        )
+
+                except StopThreadException:
+                    tmp_dir.release()
+                    with worker_statistics_lock:
+                        worker_statistics["active_download_worker"][0] -= 1
+                    return
+
+                except Exception as e:
+                    print(f"DEBUG: {key} Exception download:", e)
+                    files_http_status.append("undefined")
+
+                    tmp_dir.cleanup()
+                    with worker_statistics_lock:
+                        worker_statistics["active_download_worker"][0] -= 1
+                    continue
+
+            # figshare, zenodo: download files (and dryad if single zip file failed)
+            files_http_status = []
+            remote_bboxes = []
+            for filename, file_link, file_size, checksum in files:
+                if is_skippable(archive_probe.get(filename)):
+                    # zip file without geospatial members (helper_archive_probe)
+                    files_http_status.append("skipped")
+                    continue
+
+                try:
+                    if Path(filename).suffix.lower() in REMOTE_GEOTIFF_FORMATS:
+                        # bbox from the header via range requests, without download,
+                        # paced like the downloads of the content provider
+                        bbox = probe_remote_geotiff(
+                            session,
+                            file_link,
+                            lambda: _wait_for_provider(
+                                stop_event, content_provider, provider_sleep_info
+                            ),
+                        )
+                        if bbox:
+                            remote_bboxes.append(bbox)
+                            files_http_status.append("remote")
+                            continue
+
+                    files_http_status.append(
+                        _download(
+                            stop_event,
+                            content_provider,
+                            provider_sleep_info,
+                            session,
+                            file_link,
+                            filename,
+                            tmp_dir.name,
+                            file_size,
+                            checksum,
+                            download_cache,
+                            tmp_dir.grow,
+                        )
                     )
-                    time.sleep(1)
 
-            except StopThreadException:
-                tmp_dir.cleanup()
-                with threading.Lock():
-                    worker_statistics["active_download_worker"][0] -= 1
-                with threading.Lock():
-                    worker_statistics["total_download_worker"][0] -= 1
-                return
+                except ValueError as e:
+                    print(f"DEBUG: ValueError download for {filename}:", e)
+                    files_http_status.append("undefined")
 
-            except Exception as e:
-                print(f"DEBUG: {key} Exception download:", e)
-                files_http_status.append("undefined")
+                except HTTPError as e:
+                    print(f"DEBUG: HTTPError download for {filename}:", e)
+                    files_http_status.append(e.response.status_code)
 
-                tmp_dir.cleanup()
-                with threading.Lock():
-                    worker_statistics["active_download_worker"][0] -= 1
-                time.sleep(1)
-                continue
+                except StopThreadException:
+                    tmp_dir.release()
+                    with worker_statistics_lock:
+                        worker_statistics["active_download_worker"][0] -= 1
+                    return
 
-        # figshare, zenodo: download files (and dryad if single zip file failed)
-        files_http_status = []
-        for filename, file_link in files:
-            try:
-                resp = _request(
-                    stop_event,
+                except Exception as e:
+                    print(f"DEBUG: {key} Exception download:", e)
+                    files_http_status.append("undefined")
+
+            geoextent_queue.put(
+                [
                     content_provider,
-                    provider_sleep_info,
-                    session,
-                    file_link,
-                    throttle=True,
-                    stream=True,
-                )
-                filepath = Path(tmp_dir.name).joinpath(filename)
-                # TODO: catch http error (?)
-                with open(filepath, "wb") as dst:
-                    for chunk in resp.iter_content(chunk_size=None):
-                        dst.write(chunk)
+                    key,
+                    sum_size,
+                    files_http_status,
+                    tmp_dir,
+                    remote_bboxes,
+                ]
+            )
+            with worker_statistics_lock:
+                worker_statistics["active_download_worker"][0] -= 1
+    finally:
+        _finish_download_worker(worker_statistics, geoextent_queue)
 
-                files_http_status.append(resp.status_code)
 
-            except ValueError as e:
-                print(f"DEBUG: ValueError download for {filename}:", e)
-                files_http_status.append("undefined")
+def _finish_download_worker(worker_statistics: dict, geoextent_queue: queue.Queue):
+    with worker_statistics_lock:
+        worker_statistics["total_download_worker"][0] -= 1
+        last_download_worker = worker_statistics["total_download_worker"][0] == 0
 
-            except HTTPError as e:
-                print(f"DEBUG: HTTPError download for {filename}:", e)
-                files_http_status.append(e.response.status_code)
+    if last_download_worker:
+        # one sentinel per geoextent worker, after all downloaded datasets
+        for _ in range(worker_statistics["total_geoextent_worker"][0]):
+            geoextent_queue.put(None)
 
-            except StopThreadException:
-                tmp_dir.cleanup()
-                with threading.Lock():
-                    worker_statistics["active_download_worker"][0] -= 1
-                with threading.Lock():
-                    worker_statistics["total_download_worker"][0] -= 1
-                return
 
-            except Exception as e:
-                print(f"DEBUG: {key} Exception download:", e)
-                files_http_status.append("undefined")
+def _download(
+    stop_event: threading.Event,
+    content_provider: str,
+    provider_sleep_info: dict,
+    session,
+    url,
+    filename: str,
+    directory: str,
+    size: int | None = None,
+    checksum: str | None = None,
+    download_cache: DownloadCache | None = None,
+    reserve=None,
+) -> int:
+    """
+    Downloads a file into the staging directory of its dataset and returns the HTTP
+    status code. Partial downloads of an earlier run are continued (helper_resumable_download),
+    identical files of other datasets are linked from the download cache.
+
+    reserve: reserves the bytes of members extracted while downloading (tmp_dir.grow)
+    """
+    filepath = Path(directory).joinpath(filename)
+    if is_complete(filepath):
+        # downloaded and validated by an earlier run
+        return 200
+
+    if download_cache is not None:
+        cached_path = download_cache.lookup(checksum, url)
+        if cached_path is not None and download_cache.link(cached_path, filepath):
+            return 200
+
+    if get_streaming_format(filename) and not has_partial(filepath):
+        # extract only the geospatial members while downloading (helper_streaming_extract)
+        resp = _request(
+            stop_event,
+            content_provider,
+            provider_sleep_info,
+            session,
+            url,
+            throttle=True,
+            stream=True,
+        )
+        # the received bytes are kept in <file>.part
+        chunks = tee_response(resp, filepath, url)
+        try:
+            stream_extract(chunks, filename, directory, reserve)
+            # the archive itself is not needed
+            chunks.close()
+            discard_partial(filepath)
+            return resp.status_code
+        except StreamingNotSupported as e:
+            print(f"INFO: Download {filename} completely, no streaming extraction:", e)
+
+        # continue the same response, a broken connection is continued with a range
+        # request below
+        try:
+            for _ in chunks:
+                if stop_event.is_set():
+                    resp.close()
+                    raise StopThreadException
+        except RequestException as e:
+            print(f"INFO: Continue download of {filename}:", e)
+        else:
+            valid = validate_file(filepath, size, checksum)
+            return _finish_file(
+                filepath, url, checksum, valid, download_cache, resp.status_code
+            )
+        finally:
+            chunks.close()
 
-            finally:
-                time.sleep(1)
+    for _ in range(2):
+        headers = get_resume_headers(filepath, url)
+        try:
+            resp = _request(
+                stop_event,
+                content_provider,
+                provider_sleep_info,
+                session,
+                url,
+                throttle=True,
+                stream=True,
+                headers=headers,
+            )
+        except HTTPError as e:
+            if headers and e.response.status_code == 416:
+                # Range Not Satisfiable: start again
+                discard_partial(filepath)
+                continue
+            raise
 
-        geoextent_queue.put(
-            [content_provider, key, sum_size, files_http_status, tmp_dir]
-        )
-        with threading.Lock():
-            worker_statistics["active_download_worker"][0] -= 1
+        if not write_response(resp, filepath, url, stop_event):
+            # continued by the next run
+            raise StopThreadException
 
-    with threading.Lock():
-        worker_statistics["total_download_worker"][0] -= 1
+        valid = validate_file(filepath, size, checksum)
+        if valid or not headers:
+            return _finish_file(
+                filepath, url, checksum, valid, download_cache, resp.status_code
+            )
+
+        print(f"INFO: Continued download of {filename} is invalid, start again.")
+        discard_partial(filepath)
+
+    raise ValueError(f"Download of {filename} failed.")
+
+
+def _finish_file(
+    filepath: Path,
+    url,
+    checksum: str | None,
+    valid: bool,
+    download_cache: DownloadCache | None,
+    status_code: int,
+) -> int:
+    # a download from the beginning is kept even if it does not match
+    if not valid:
+        print(f"WARNING: {filepath.name} does not match size or checksum.")
+    finish_download(filepath)
+    if download_cache is not None and valid:
+        # e.g. a truncated download would be served for its URL in later runs
+        download_cache.add(filepath, checksum, url)
+    return status_code
 
 
 def _request(
@@ -215,6 +426,7 @@ def _request(
     **kwargs,
 ):
     while True:
+        _wait_for_provider(stop_event, content_provider, provider_sleep_info)
         # TODO: except http error and retry
         try:
             response = session.get(url, **kwargs)
@@ -239,6 +451,31 @@ def _request(
     return response
 
 
+def _wait_for_provider(
+    stop_event: threading.Event,
+    content_provider: str,
+    provider_sleep_info: dict,
+):
+    """
+    Waits for the next request slot of the content provider: the requests of all its
+    download workers are at least REQUEST_INTERVAL apart and wait for a rate limit
+    reset (_throttle).
+    """
+    while True:
+        with provider_sleep_lock:
+            sleep_info = provider_sleep_info[content_provider]
+            now = time.time()
+            if sleep_info[0] and sleep_info[0] <= now:
+                sleep_info[0] = None
+            request_time = max(now, sleep_info[0] or 0, sleep_info[1] or 0)
+            if request_time <= now:
+                sleep_info[1] = now + REQUEST_INTERVAL
+                return
+
+        if stop_event.wait(request_time - now):
+            raise StopThreadException
+
+
 def _throttle(
     stop_event: threading.Event,
     content_provider: str,
@@ -285,19 +522,17 @@ def _throttle(
 
     if wait_seconds > 60:
         print(f"INFO: Sleep {wait_seconds:.0f} s")
-        provider_sleep_info[content_provider][0] = reset_time
 
-    while True:
-        if stop_event.is_set():
-            raise StopThreadException
-        if wait_seconds > 60:
-            time.sleep(60)
-            wait_seconds -= 60
-        else:
-            time.sleep(wait_seconds)
-            break
+    # the next request of any download worker of the content provider waits
+    # (_wait_for_provider)
+    with provider_sleep_lock:
+        sleep_info = provider_sleep_info[content_provider]
+        sleep_info[1] = max(sleep_info[1] or 0, time.time() + wait_seconds)
+        if wait_seconds > 60 and reset_time and reset_time > (sleep_info[0] or 0):
+            sleep_info[0] = reset_time
 
-    provider_sleep_info[content_provider][0] = None
+    if stop_event.is_set():
+        raise StopThreadException
 
     return
 
@@ -306,83 +541,97 @@ def geoextent_worker(
     geoextent_queue: queue.Queue,
     result_queue: queue.Queue,
     worker_statistics: dict,
-    stop_event: list,
+    geoextent_pool: GeoextentPool,
+    sqlite_path: str,
+    timeout_model: TimeoutModel,
+    geoextent_per_file: bool = False,
 ):
-    while True:
-        counter_stop_event = sum(event.is_set() for event in stop_event)
-        if (
-            counter_stop_event == len(stop_event)
-            and geoextent_queue.empty()
-            and worker_statistics["active_download_worker"][0] == 0
-        ):
-            break
-
-        try:
-            content_provider, key, sum_size, files_http_status, tmp_dir = (
-                geoextent_queue.get(timeout=60)
-            )
-        except queue.Empty:
-            continue
+    # read only, shared with the threads of run_per_file
+    conn = sqlite3.connect(sqlite_path, check_same_thread=False)
 
-        with threading.Lock():
-            worker_statistics["active_geoextent_worker"][0] += 1
-
-        try:
-            # multiprocesing to kill process
-            # (for example, while a huge csv file is being processed,
-            # the timeout mechanism of geoextent do not work)
-            timeout_geoextent = 30 * 60  # [s]
-            timeout_multiprocessing = 2 * timeout_geoextent  # [s]
-
-            multiprocessing_queue = multiprocessing.Queue()
-            process = multiprocessing.Process(
-                target=run_geoextent,
-                args=(
-                    tmp_dir.name,
-                    multiprocessing_queue,
-                    timeout_geoextent,
-                    key,
-                ),
-            )
-            process.start()
-            process.join(timeout=timeout_multiprocessing)
-            if process.is_alive():
-                print(
-                    f"Process terminated after {timeout_multiprocessing} s. Key:", key
-                )
-                process.terminate()
-                process.join()
+    try:
+        while True:
+            task = geoextent_queue.get()
+            if task is None:
+                # sentinel of the last download worker
+                break
+            (
+                content_provider,
+                key,
+                sum_size,
+                files_http_status,
+                tmp_dir,
+                remote_bboxes,
+            ) = task
+
+            with worker_statistics_lock:
+                worker_statistics["active_geoextent_worker"][0] += 1
 
-            if not multiprocessing_queue.empty():
-                metadata = multiprocessing_queue.get()
-            else:
-                metadata = {"timeout": timeout_multiprocessing}
+            try:
+                # persistent process pool to kill processes
+                # (for example, while a huge csv file is being processed,
+                # the timeout mechanism of geoextent do not work)
+                # predicted from earlier processing times of the extension and size
+                # (helper_timeout_model), at most the cap (30 min)
+                timeout_geoextent = timeout_model.get_timeout(tmp_dir.name)  # [s]
+                timeout_multiprocessing = 2 * timeout_geoextent  # [s]
+
+                # results of earlier runs (file_extents), new results are written by result_consumer
+                memo = ExtentMemo(geoextent_pool, conn)
+
+                if not any(Path(tmp_dir.name).iterdir()):
+                    # all files were skipped or read remotely
+                    metadata = {}
+                elif geoextent_per_file:
+                    # timeouts per file instead of per dataset
+                    metadata = run_per_file(
+                        geoextent_pool,
+                        tmp_dir.name,
+                        timeout_geoextent,
+                        timeout_multiprocessing,
+                        key,
+                        memo,
+                        timeout_model,
+                        tmp_dir,
+                    )
+                else:
+                    metadata = memo.run(
+                        tmp_dir.name, timeout_geoextent, timeout_multiprocessing, key
+                    )
+                metadata["file_extents"] = memo.rows
+                metadata["geoextent_timings"] = memo.timings
 
-        except Exception as e:
-            print("DEBUG: Exception multiprocessing:", e)
-            metadata = {}
+            except Exception as e:
+                print("DEBUG: Exception multiprocessing:", e)
+                metadata = {}
 
-        tmp_dir.cleanup()
-        result_queue.put([content_provider, key, sum_size, files_http_status, metadata])
+            try:
+                if remote_bboxes:
+                    # GeoTIFFs read via range requests (helper_remote_geotiff)
+                    metadata["bbox"] = merge_bboxes(
+                        [metadata.get("bbox"), *remote_bboxes]
+                    )
+                    metadata.setdefault("crs", "4326")
 
-        with threading.Lock():
-            worker_statistics["active_geoextent_worker"][0] -= 1
+                result_queue.put(
+                    [content_provider, key, sum_size, files_http_status, metadata]
+                )
+            finally:
+                tmp_dir.cleanup()
+                with worker_statistics_lock:
+                    worker_statistics["active_geoextent_worker"][0] -= 1
 
-    with threading.Lock():
-        worker_statistics["total_geoextent_worker"][0] -= 1
+    finally:
+        # also after an unexpected exception, result_consumer waits for the sentinel
+        conn.close()
 
+        with worker_statistics_lock:
+            worker_statistics["total_geoextent_worker"][0] -= 1
+            last_geoextent_worker = worker_statistics["total_geoextent_worker"][0] == 0
 
-def run_geoextent(
-    tmp: str, multiprocessing_queue: multiprocessing.Queue, timeout: int, key: int
-) -> dict:
-    try:
-        metadata = geoextent.fromDirectory(path=tmp, bbox=True, timeout=timeout)
-    except Exception as e:
-        # TODO: mehr printen für debug
-        print(f"DEBUG: {key} Exception geoextent:", e)
-        metadata = {}
-    finally:
-        multiprocessing_queue.put(metadata)
+        if last_geoextent_worker:
+            # sentinel for result_consumer, after all results
+            result_queue.put(None)
 
 
 def result_consumer(
@@ -395,131 +644,176 @@ def result_consumer(
     content_provider_list: list,
     worker_statistics: dict,
     provider_sleep_info: dict,
+    disk_budget: DiskBudget | TieredStaging,
+    commit_rows: int = 100,
+    commit_seconds: float = 30,
 ):
     threshold_time = 10 * 60 * 60  # [s]  (10 h)
     threshold_counter = 60  # datasets per content provider
 
     # Connect to SQLite database
-    conn = sqlite3.connect(sqlite_path)
+    conn = sqlite3.connect(sqlite_path, timeout=60)
+    # WAL: readers (e.g. helper_quantile, jupyter notebook) and the writer do not block
+    # each other, synchronous=NORMAL is durable for committed transactions except on
+    # power loss
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
     cursor = conn.cursor()
 
-    while True:
-        metadata_to_process = None
-        try:
-            content_provider, key, sum_size, files_http_status, metadata = (
-                result_queue.get(timeout=10)
-            )
-            metadata_to_process = True
-        except queue.Empty:
-            pass
-
-        if metadata_to_process:
-            insert_query_statistics = """
-                UPDATE statistics_dataset_analysis 
-                SET processed_counter = ?,
-                    processed_data_volume = ?,
-                    timeout_counter = ?,
-                    with_bbox = ?
-                WHERE content_provider = ?
-            """
-            insert_query_datasets = """
-                UPDATE datasets 
-                SET files_http_status_code = ?,
-                    bbox = ?,
-                    processed_flag = 1,
-                    timeout = ?,
-                    time_result_insert = ?
-                WHERE key = ?
-            """
-
-            statistics_dict[content_provider]["processed_counter"] += 1
-            statistics_dict[content_provider]["processed_data_volume"] += sum_size
-
-            bbox = metadata.get("bbox")
-            timeout = int(timeout) if (timeout := metadata.get("timeout")) else None
+    # results are written in groups (commit_rows datasets or after commit_seconds)
+    pending_datasets = []
+    pending_bboxes = []
+    pending_file_extents = []
+    pending_timings = []
+    time_last_commit = time.time()
 
-            if bbox and not any(math.isnan(x) for x in bbox):
-                statistics_dict[content_provider]["with_bbox"] += 1
-                bbox_json = json.dumps(metadata["bbox"])
-                files_http_status_code_json = json.dumps(files_http_status)
-                cursor.execute(
-                    insert_query_datasets,
+    try:
+        finished = False
+        while True:
+            try:
+                result = result_queue.get(timeout=10)
+                if result is None:
+                    # all geoextent workers are finished
+                    finished = True
+                    result = []
+            except queue.Empty:
+                result = []
+
+            if result:
+                content_provider, key, sum_size, files_http_status, metadata = result
+
+                bbox = metadata.get("bbox")
+                if not bbox or any(math.isnan(x) for x in bbox):
+                    bbox = None
+                timeout = int(timeout) if (timeout := metadata.get("timeout")) else None
+
+                pending_datasets.append(
                     (
-                        files_http_status_code_json,
-                        bbox_json,
+                        json.dumps(files_http_status),
+                        json.dumps(bbox) if bbox else None,
                         timeout,
                         int(time.time()),
                         key,
-                    ),
+                    )
                 )
-            else:
-                files_http_status_code_json = json.dumps(files_http_status)
-                cursor.execute(
-                    insert_query_datasets,
-                    (files_http_status_code_json, None, timeout, int(time.time()), key),
+                pending_bboxes.append((key, bbox))
+                # geoextent results per file or directory (helper_file_extents)
+                pending_file_extents.extend(metadata.pop("file_extents", []))
+                pending_timings.extend(metadata.pop("geoextent_timings", []))
+
+            if pending_datasets and (
+                len(pending_datasets) >= commit_rows
+                or time.time() - time_last_commit >= commit_seconds
+            ):
+                write_results(
+                    cursor,
+                    pending_datasets,
+                    pending_bboxes,
+                    pending_file_extents,
+                    pending_timings,
                 )
-
-            if timeout:
-                statistics_dict[content_provider]["timeout_counter"] += 1
-
-            cursor.execute(
-                insert_query_statistics,
-                (
-                    statistics_dict[content_provider]["processed_counter"],
-                    statistics_dict[content_provider]["processed_data_volume"],
-                    statistics_dict[content_provider]["timeout_counter"],
-                    statistics_dict[content_provider]["with_bbox"],
-                    content_provider,
+                conn.commit()
+                time_last_commit = time.time()
+                pending_datasets = []
+                pending_bboxes = []
+                pending_file_extents = []
+                pending_timings = []
+                # statistics_dataset_analysis is updated by triggers (helper_sqlite_schema)
+                statistics_dict.update(get_statistics(cursor))
+
+            print(
+                "status:",
+                "Runtime:",
+                f"{time.strftime('%H:%M:%S', time.gmtime(time.time() - time_begin))} |",
+                "Dryad:",
+                generate_output_text(
+                    statistics_dict["dryad"], provider_sleep_info["dryad"][0]
+                ),
+                "Figshare:",
+                generate_output_text(
+                    statistics_dict["figshare"], provider_sleep_info["figshare"][0]
+                ),
+                "Zenodo:",
+                generate_output_text(
+                    statistics_dict["zenodo"], provider_sleep_info["zenodo"][0]
                 ),
+                f"Active download worker: {worker_statistics['active_download_worker'][0]}/{worker_statistics['total_download_worker'][0]} |",
+                f"Active geoextent worker: {worker_statistics['active_geoextent_worker'][0]}/{worker_statistics['total_geoextent_worker'][0]} |",
+                f"Geoextent-Queue: {geoextent_queue.qsize()} |",
+                f"Disk: {disk_budget.status_text()} |",
+                f"Result-Queue: {result_queue.qsize()}",
             )
 
-            conn.commit()
+            for index, name in enumerate(content_provider_list):
+                # Stop download worker if number of processed datasets is reached
+                first_condition = (
+                    statistics_dict[name]["processed_counter"] >= threshold_counter
+                )
+                # Stop download worker if time passed
+                first_condition = (time.time() - time_begin) > threshold_time
+                if first_condition and not stop_event[index].is_set():
+                    stop_event[index].set()
+                    print(
+                        f"Send stop signal to {name.title()} download worker stopped."
+                    )
 
-        print(
-            "status:",
-            "Runtime:",
-            f"{time.strftime('%H:%M:%S', time.gmtime(time.time() - time_begin))} |",
-            "Dryad:",
-            generate_output_text(
-                statistics_dict["dryad"], provider_sleep_info["dryad"][0]
-            ),
-            "Figshare:",
-            generate_output_text(
-                statistics_dict["figshare"], provider_sleep_info["figshare"][0]
-            ),
-            "Zenodo:",
-            generate_output_text(
-                statistics_dict["zenodo"], provider_sleep_info["zenodo"][0]
-            ),
-            f"Active download worker: {worker_statistics['active_download_worker'][0]}/{worker_statistics['total_download_worker'][0]} |",
-            f"Active geoextent worker: {worker_statistics['active_geoextent_worker'][0]}/{worker_statistics['total_geoextent_worker'][0]} |",
-            f"Geoextent-Queue: {geoextent_queue.qsize()} |",
-            f"Result-Queue: {result_queue.qsize()}",
+            # Finish after the sentinel of the last geoextent worker
+            if finished:
+                break
+
+    finally:
+        # no result is lost on shutdown
+        write_results(
+            cursor,
+            pending_datasets,
+            pending_bboxes,
+            pending_file_extents,
+            pending_timings,
         )
+        conn.commit()
+        conn.close()
 
-        for index, name in enumerate(content_provider_list):
-            # Stop download worker if number of processed datasets is reached
-            first_condition = (
-                statistics_dict[name]["processed_counter"] >= threshold_counter
-            )
-            # Stop download worker if time passed
-            first_condition = (time.time() - time_begin) > threshold_time
-            if first_condition and not stop_event[index].is_set():
-                stop_event[index].set()
-                print(f"Send stop signal to {name.title()} download worker stopped.")
-
-        # Finish if all workers are stopped
-        counter_stop_event = sum(event.is_set() for event in stop_event)
-        if (
-            counter_stop_event == len(stop_event)
-            and geoextent_queue.empty()
-            and result_queue.empty()
-            and worker_statistics["active_download_worker"][0] == 0
-            and worker_statistics["active_geoextent_worker"][0] == 0
-        ):
-            break
 
-    conn.close()
+def write_results(
+    cursor: sqlite3.Cursor,
+    datasets: list,
+    bboxes: list,
+    file_extents: list,
+    timings: list,
+):
+    cursor.executemany(
+        """
+        UPDATE datasets
+        SET files_http_status_code = ?,
+            bbox = ?,
+            processed_flag = 1,
+            timeout = ?,
+            time_result_insert = ?
+        WHERE key = ?
+        """,
+        datasets,
+    )
+    update_spatial_index_many(cursor, bboxes)
+    cursor.executemany(INSERT_FILE_EXTENT_QUERY, file_extents)
+    cursor.executemany(INSERT_TIMING_QUERY, timings)
+
+
+def get_statistics(cursor: sqlite3.Cursor) -> dict:
+    cursor.execute("""
+        SELECT content_provider, processed_counter, processed_data_volume, timeout_counter, with_bbox
+        FROM statistics_dataset_analysis
+        """)
+
+    statistics_dict = {}
+    for row in cursor.fetchall():
+        statistics_dict[row[0]] = {
+            "processed_counter": row[1],
+            "processed_data_volume": row[2],
+            "timeout_counter": row[3],
+            "with_bbox": row[4],
+        }
+
+    return statistics_dict
 
 
 def generate_output_text(statistics: dict, reset_time: int):
@@ -541,7 +835,43 @@ def generate_output_text(statistics: dict, reset_time: int):
 
 def main(
     sqlite_path: str = None,
+    size_quantile: float | None = None,
+    download_worker_per_provider: int | dict = 1,
+    temp_parent: str = "/run/media/lars/8f0c1f09-2c90-4cb3-ac63-19295ea5ede3/tmp",
+    disk_budget_bytes: int | None = None,
+    memory_parent: str | None = "/dev/shm/dataset_analysis",
+    memory_budget_bytes: int = 2 * 1024**3,
+    memory_threshold_bytes: int = 64 * 1024**2,
+    download_cache_bytes: int = 20 * 1024**3,
+    geoextent_max_rss_bytes: int | None = 4 * 1024**3,
+    geoextent_memory_limit_bytes: int | None = 8 * 1024**3,
+    geoextent_max_processes: int | None = None,
+    geoextent_per_file: bool = False,
+    geoextent_timeout_cap: int = 30 * 60,
 ):
+    """
+    download_worker_per_provider: number of download workers per content provider, e.g.
+                                  {"zenodo": 2}. The workers of a content provider share
+                                  its rate limit.
+    disk_budget_bytes: bytes of temp_parent which downloads waiting for geoextent may use
+                       at once (default: free space). Larger datasets are skipped.
+    memory_parent: RAM-backed (tmpfs) staging for datasets up to memory_threshold_bytes,
+                   with memory_budget_bytes at once (None: everything on temp_parent).
+    download_cache_bytes: size of the content-addressed cache of downloaded files in
+                          temp_parent (0: no cache).
+    geoextent_max_rss_bytes: geoextent processes are restarted above this memory usage.
+    geoextent_memory_limit_bytes: address space limit (RLIMIT_AS) of each geoextent
+                                  process.
+    geoextent_max_processes: maximum number of geoextent processes (default: cores), the
+                             pool is scaled with free memory and queue depth.
+    geoextent_per_file: process the files of a dataset (and extracted archive members)
+                        in parallel with a timeout per file and merge their bboxes.
+    geoextent_timeout_cap: maximum geoextent timeout [s], the timeouts are predicted from
+                           the processing times of earlier runs (helper_timeout_model).
+    size_quantile: if set, datasets above this sum_size quantile of their content provider
+                   are skipped, estimated with helper_quantile_sketch. Otherwise the
+                   hardcoded 0.95-quantiles are used.
+    """
     time_begin = time.time()
 
     print(time_begin)
@@ -555,51 +885,78 @@ def main(
     # Connect to SQLite database
     conn = sqlite3.connect(sqlite_path)
     cursor = conn.cursor()
-
-    # Get statistics
-    cursor.execute("SELECT * FROM statistics_dataset_analysis")
-    statistics = cursor.fetchall()  # is a list
-
-    if not statistics:
-        # Initialize SQLite statistics
-        cursor.execute("""
-            INSERT INTO statistics_dataset_analysis 
-            (content_provider, processed_counter, processed_data_volume, timeout_counter, with_bbox) 
-            VALUES 
-            ('dryad', 0, 0, 0, 0),
-            ('figshare', 0, 0, 0, 0),
-            ('zenodo', 0, 0, 0, 0)
-        """)
-        conn.commit()
-
-    cursor.execute(
-        "SELECT * FROM statistics_dataset_analysis",
+    migrate(conn)
+
+    # Initialize SQLite statistics (maintained by triggers)
+    cursor.executemany(
+        """
+        INSERT OR IGNORE INTO statistics_dataset_analysis
+        (content_provider, processed_counter, processed_data_volume, timeout_counter, with_bbox)
+        VALUES (?, 0, 0, 0, 0)
+        """,
+        [(provider,) for provider in ["dryad", "figshare", "zenodo"]],
     )
-    results = cursor.fetchall()
+    conn.commit()
 
-    statistics_dict = {}
-    for row in results:
-        statistics_dict[row[1]] = {
-            "processed_counter": row[2],
-            "processed_data_volume": row[3],
-            "timeout_counter": row[4],
-            "with_bbox": row[5],
+    statistics_dict = get_statistics(cursor)
+
+    if isinstance(download_worker_per_provider, int):
+        download_worker_per_provider = {
+            provider: download_worker_per_provider for provider in content_provider
         }
+    download_worker_count = [
+        download_worker_per_provider.get(provider, 1) for provider in content_provider
+    ]
 
     stop_event = []
     worker_statistics = {
         "active_download_worker": [0],
-        "total_download_worker": [len(content_provider)],
+        "total_download_worker": [sum(download_worker_count)],
         "active_geoextent_worker": [0],
-        "total_geoextent_worker": [2 * len(content_provider)],  # maybe just 3 not 6
+        # one thread per possible geoextent process, PoolAutoscaler limits the processes
+        "total_geoextent_worker": [geoextent_max_processes or get_cpu_count()],
     }
     provider_sleep_info = {}
+    # staging directories of earlier runs: continue pending datasets, remove the rest
+    cursor.execute(
+        "SELECT key FROM datasets WHERE download_flag = 1 AND processed_flag = 0"
+    )
+    pending_keys = {key for (key,) in cursor.fetchall()}
+    reused, removed = cleanup_orphans(temp_parent, pending_keys)
+    if memory_parent:
+        reused_memory, removed_memory = cleanup_orphans(memory_parent, pending_keys)
+        reused += reused_memory
+        removed += removed_memory
+    if reused or removed:
+        print(
+            f"Staging directories of earlier runs: {reused} continued, {removed} removed."
+        )
+    download_cache = None
+    safety_margin_bytes = 2 * 1024**3
+    if download_cache_bytes:
+        download_cache = DownloadCache(
+            Path(temp_parent).joinpath("download_cache"), download_cache_bytes
+        )
+        # space which the cache may still take
+        safety_margin_bytes += max(0, download_cache_bytes - download_cache.size())
+    memory_budget = None
+    if memory_parent:
+        memory_budget = DiskBudget(
+            memory_parent, memory_budget_bytes, safety_margin_bytes=512 * 1024**2
+        )
+    disk_budget = TieredStaging(
+        DiskBudget(temp_parent, disk_budget_bytes, safety_margin_bytes),
+        memory_budget,
+        memory_threshold_bytes,
+    )
 
     for provider in content_provider:
-        provider_sleep_info[provider] = [None]
+        # [rate limit reset time, time of the next request]
+        provider_sleep_info[provider] = [None, None]
 
     # Create queues for tasks and results
-    download_queues = [queue.Queue() for _ in range(len(content_provider))]
+    # highest expected bboxes per second first (helper_scheduler)
+    download_queues = [PriorityTaskQueue() for _ in range(len(content_provider))]
     geoextent_queue = queue.Queue()
     result_queue = queue.Queue()
 
@@ -616,6 +973,7 @@ def main(
             content_provider,
             worker_statistics,
             provider_sleep_info,
+            disk_budget,
         ),
     )
     consumer_thread.start()
@@ -630,39 +988,104 @@ def main(
         2200229344.25,     #  2.05 GiB
         19707810956.6,     # 18.35 GiB
     ]
+    if size_quantile:
+        # thresholds from the persisted quantile sketches (datasets with download flag)
+        sketches = update_sketches(sqlite_path)
+        for index, provider in enumerate(content_provider):
+            threshold, rank_error = get_quantile(sketches, size_quantile, provider)
+            if threshold is not None:
+                theshold_size_byte[index] = threshold
+                print(
+                    f"{provider.title()}: {size_quantile}-quantile {threshold / 1024**3:.2f} GiB "
+                    + f"(rank error ±{rank_error * 100:.2f} %)"
+                )
+
+    # observed success rates of earlier runs
+    flag_rates, extension_rates = get_success_rates(cursor)
 
     # Get all datasets of interest for each content provider
     for index, provider in enumerate(content_provider):
         stop_event.append(threading.Event())
 
         cursor.execute(
-            "SELECT key, doi, files, sum_size FROM datasets WHERE content_provider = ? AND download_flag = 1 AND processed_flag = 0 AND sum_size < ?",
+            """
+            SELECT datasets.key, doi, sum_size, archive_probe, files_types, geospatial_flag,
+                dataset_files.name, dataset_files.url, dataset_files.size, dataset_files.checksum
+            FROM datasets LEFT JOIN dataset_files ON dataset_files.dataset_key = datasets.key
+            WHERE content_provider = ? AND download_flag = 1 AND processed_flag = 0 AND sum_size < ?
+            ORDER BY datasets.key, dataset_files.id
+            """,
             (provider, theshold_size_byte[index]),
         )
         results = cursor.fetchall()
 
-        for key, doi, files, sum_size in results:
-            download_queues[index].put((key, doi, json.loads(files), sum_size))
+        for (
+            key,
+            doi,
+            sum_size,
+            archive_probe,
+            files_types,
+            geospatial_flag,
+        ), rows in itertools.groupby(results, key=lambda row: row[:6]):
+            files = [
+                [name, url, size, checksum]
+                for *_, name, url, size, checksum in rows
+                if name is not None
+            ]
+            priority = get_priority(
+                files_types,
+                geospatial_flag,
+                sum_size,
+                len(files),
+                flag_rates,
+                extension_rates,
+            )
+            download_queues[index].put(
+                (
+                    priority,
+                    (key, doi, files, sum_size, json.loads(archive_probe or "{}")),
+                )
+            )
+        # one sentinel per download worker, after all datasets
+        for _ in range(download_worker_count[index]):
+            download_queues[index].put(None)
 
-        # TODO: maybe add two download worker per content provider
-        # for i in range(2):
-        download_thread = threading.Thread(
-            target=download_worker,
-            args=(
-                stop_event[index],
-                download_queues[index],
-                geoextent_queue,
-                result_queue,
-                worker_statistics,
-                provider,
-                provider_sleep_info,
-            ),
-        )
-        download_thread.start()
-        download_workers.append(download_thread)
+        for _ in range(download_worker_count[index]):
+            download_thread = threading.Thread(
+                target=download_worker,
+                args=(
+                    stop_event[index],
+                    download_queues[index],
+                    geoextent_queue,
+                    result_queue,
+                    worker_statistics,
+                    provider,
+                    provider_sleep_info,
+                    disk_budget,
+                    download_cache,
+                ),
+            )
+            download_thread.start()
+            download_workers.append(download_thread)
+
+    # timeouts from the processing times of earlier runs
+    timeout_model = TimeoutModel(cursor, max_timeout=geoextent_timeout_cap)
 
     conn.close()
 
+    # long-lived geoextent processes, sized with the cores, free memory and the depth of
+    # geoextent_queue
+    geoextent_pool = GeoextentPool(
+        1, geoextent_max_rss_bytes, geoextent_memory_limit_bytes
+    )
+    autoscaler = PoolAutoscaler(
+        geoextent_pool,
+        geoextent_queue,
+        max_processes=worker_statistics["total_geoextent_worker"][0],
+    )
+    geoextent_pool.resize(autoscaler.get_target())
+    autoscaler.start()
+
     for i in range(worker_statistics["total_geoextent_worker"][0]):
         geoextent_thread = threading.Thread(
             target=geoextent_worker,
@@ -670,7 +1093,10 @@ def main(
                 geoextent_queue,
                 result_queue,
                 worker_statistics,
-                stop_event,
+                geoextent_pool,
+                sqlite_path,
+                timeout_model,
+                geoextent_per_file,
             ),
         )
         geoextent_thread.start()
@@ -682,6 +1108,10 @@ def main(
     for t in geoextent_workers:
         t.join()
     consumer_thread.join()
+    autoscaler.stop()
+    geoextent_pool.close()
+    if download_cache is not None:
+        download_cache.close()
 
     time_diff = time.time() - time_begin
     time_str = time.strftime("%H:%M:%S", time.gmtime(time_diff))
@@ -9,6 +9,10 @@ from tinydb import TinyDB
 
 from helper_metadata_downloader import get_metadata
 from helper_metadata_downloader import get_normalized_metadata
+from helper_quantile_sketch import add_to_sketches
+from helper_quantile_sketch import get_metadata_flags
+from helper_quantile_sketch import load_sketches_file
+from helper_quantile_sketch import save_sketches_file
 
 
 def worker_process(
@@ -28,6 +32,12 @@ def worker_process(
             continue
 
 
+def get_sketches_path(checkpoint_path: str) -> Path:
+    return Path(checkpoint_path).with_name(
+        Path(checkpoint_path).stem + "_sketches.json"
+    )
+
+
 def result_consumer(
     stop_event: threading.Event,
     result_queue: queue.Queue,
@@ -65,6 +75,11 @@ def result_consumer(
 
     metadata_pending_insert = []
 
+    # sum_size quantile sketches of the harvested records, saved with the checkpoint
+    # (helper_quantile_sketch, seeded into the database by convert_tinydb_to_sqlite3)
+    sketches_path = get_sketches_path(checkpoint_path)
+    sketches = load_sketches_file(sketches_path)
+
     while True:
         dryad_good = status["dryad"]["counter_successful"]
         dryad_total = dryad_good + status["dryad"]["counter_failed"]
@@ -102,6 +117,7 @@ def result_consumer(
 
                 db.insert_multiple(metadata_pending_insert)
                 metadata_pending_insert = []
+                save_sketches_file(sketches, sketches_path)
 
             if stop_event.is_set():
                 break
@@ -132,6 +148,14 @@ def result_consumer(
 
             metadata_pending_insert.append(metadata)
 
+            if normalized_metadata and normalized_metadata["sum_size"] is not None:
+                add_to_sketches(
+                    sketches,
+                    content_provider,
+                    normalized_metadata["sum_size"],
+                    get_metadata_flags(normalized_metadata),
+                )
+
             # print("\r\033[K", content_provider, identifier)
 
         if dryad_total > 0 and figshare_total > 0 and zenodo_total > 0: